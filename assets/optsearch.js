@@ -0,0 +1,133 @@
+// Search over the prebuilt inverted index of the index page (see
+// build_search_index in opt-viewer.py): token -> ids of the rows containing
+// it, split into deflated shards by the first two characters of the token.
+// Shards are loaded through script tags, which also works over file://.
+var optSearch = (function() {
+    var numShards = 1;
+    var shards = {};    // shard id -> Promise of {token: sorted row ids}
+    var resolvers = {};
+    var prefixCache = {};
+
+    function tokenize(text) {
+        return text.toLowerCase().match(/[a-z0-9_]+/g) || [];
+    }
+
+    function shardOf(token) {
+        var second = token.length > 1 ? token.charCodeAt(1) : 0;
+        return (token.charCodeAt(0) * 128 + second) % numShards;
+    }
+
+    function decode(b64) {
+        var bytes = Uint8Array.from(atob(b64), function(c) { return c.charCodeAt(0); });
+        var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+        return new Response(stream).json().then(function(postings) {
+            // Posting lists are delta encoded
+            for (var token in postings) {
+                var ids = postings[token];
+                for (var i = 1; i < ids.length; i++) {
+                    ids[i] += ids[i - 1];
+                }
+            }
+            return postings;
+        });
+    }
+
+    function loadShard(id) {
+        if (!(id in shards)) {
+            shards[id] = new Promise(function(resolve, reject) {
+                resolvers[id] = resolve;
+                var script = document.createElement('script');
+                script.src = 'search/' + id + '.js';
+                script.onerror = reject;
+                document.head.appendChild(script);
+            });
+        }
+        return shards[id];
+    }
+
+    // Called by the shard scripts
+    function addShard(id, b64) {
+        resolvers[id](decode(b64));
+        delete resolvers[id];
+    }
+
+    function union(lists) {
+        if (lists.length == 1) {
+            return lists[0];
+        }
+        var ids = new Set();
+        lists.forEach(function(list) { list.forEach(function(id) { ids.add(id); }); });
+        return Array.from(ids).sort(function(a, b) { return a - b; });
+    }
+
+    function intersect(a, b) {
+        var result = [];
+        for (var i = 0, j = 0; i < a.length && j < b.length;) {
+            if (a[i] < b[j]) {
+                i++;
+            } else if (a[i] > b[j]) {
+                j++;
+            } else {
+                result.push(a[i]);
+                i++;
+                j++;
+            }
+        }
+        return result;
+    }
+
+    // Rows with a token starting with `word`, so results show up while typing.
+    // A single character (as in "a.h") would be the prefix of tokens in many
+    // shards - it only matches the token that is just that character.
+    function rowsWithPrefix(word) {
+        if (!(word in prefixCache)) {
+            prefixCache[word] = loadShard(shardOf(word)).then(function(postings) {
+                if (word.length == 1) {
+                    return postings[word] || [];
+                }
+                var lists = [];
+                for (var token in postings) {
+                    if (token.startsWith(word)) {
+                        lists.push(postings[token]);
+                    }
+                }
+                return lists.length ? union(lists) : [];
+            });
+        }
+        return prefixCache[word];
+    }
+
+    // Resolves to the sorted ids of the rows matching all words of `query`,
+    // or null if it has nothing to search for
+    function query(text) {
+        var words = tokenize(text);
+        if (!words.length) {
+            return Promise.resolve(null);
+        }
+        return Promise.all(words.map(rowsWithPrefix)).then(function(lists) {
+            lists.sort(function(a, b) { return a.length - b.length; });
+            return lists.reduce(intersect);
+        });
+    }
+
+    // Run queries as `input` changes, handing the matching row ids (null for
+    // all rows) to `onResult` - dropping the results of outdated queries
+    function attach(input, shardCount, onResult) {
+        numShards = shardCount;
+        var latest = 0;
+        var timer = null;
+        input.addEventListener('input', function() {
+            clearTimeout(timer);
+            timer = setTimeout(function() {
+                var seq = ++latest;
+                query(input.value).then(function(ids) {
+                    if (seq == latest) {
+                        onResult(ids);
+                    }
+                });
+            }, 50);
+        });
+    }
+
+    return {addShard: addShard, attach: attach, query: query};
+})();
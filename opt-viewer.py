@@ -7,22 +7,29 @@ import os.path
 import re
 import shutil
 import sys
+import tempfile
+import time
 import json
 import glob
+import io
+import base64
+import itertools
 import pathlib
 import collections
 from datetime import datetime
-from pygments import highlight
-from pygments.lexers.c_cpp import CppLexer
-from pygments.formatters import HtmlFormatter
 import config_parser
 import multiprocessing
 import platform
 import logging
+import zlib
 
 import optpmap
-from optrecord import Remark, Passed, RemarkKey, gather_results, find_opt_files, make_link, html_file_name, \
-    DictLine2Remarks, DictFile2Remarks
+from optarchive import ReportArchive
+from optcheck import run_check
+from optrecord import Remark, RemarkKey, get_remarks, gather_results, spill_results, find_opt_files, iter_opt_files, \
+    read_manifest, load_partition, partition_dirs, new_file_remarks, merge_file_remarks, num_unique_remarks, \
+    group_locations, make_link, html_file_name, LocationGroup, DictLine2Remarks, DictFile2Remarks, RemarkFilter, \
+    SampleProfile, set_sample_profile, have_libyaml
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
@@ -35,22 +42,29 @@ The tools requires PyYAML and Pygments Python packages.'''
 # This allows passing the global context to the child processes.
 class Context:
     def __init__(self, caller_loc=dict()):
-        # Map function names to their source location for function where inlining happened
+        # Map function names to their source location (gathered from all
+        # remarks, including filtered out ones), for inline context links
         self.caller_loc = caller_loc
 
 
 context = Context()
 
 
-def render_file_source(source_dir: str, output_dir: str, filename: str,
-                       line_remarks: DictLine2Remarks):
-    html_filename = os.path.join(output_dir, html_file_name(filename))
+@functools.lru_cache(maxsize=None)
+def _highlighter():
+    # pygments is only needed for the source pages: imported on first use, once per process
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers.c_cpp import CppLexer
+    return highlight, CppLexer(stripnl=False), HtmlFormatter(encoding='utf-8')
+
+
+def write_file_source(f: IO, source_dir: str, filename: str, line_remarks: DictLine2Remarks):
     filename = filename if os.path.exists(filename) else os.path.join(source_dir, filename)
 
-    html_formatter = HtmlFormatter(encoding='utf-8')
-    cpp_lexer = CppLexer(stripnl=False)
+    highlight, cpp_lexer, html_formatter = _highlighter()
 
-    def render_source_lines(stream: IO, line_remarks: dict[int, list[Remark]]):
+    def render_source_lines(stream: IO, line_remarks: DictLine2Remarks):
         file_text = stream.read()
 
         html_highlighted = highlight(
@@ -72,15 +86,14 @@ def render_file_source(source_dir: str, output_dir: str, filename: str,
                    '',
                    f'<div class="highlight"><pre>{html_line}</pre></div>', '']
 
-            cur_line_remarks = line_remarks.get(linenum, [])
-            from collections import defaultdict
-            d: dict[str, list[Remark]] = defaultdict(list)
-            count_deleted: dict[str, int] = defaultdict(int)
+            # Remarks were already capped per name when gathered (see LineRemarks)
+            cur_line_remarks = line_remarks.get(linenum)
+            if not cur_line_remarks:
+                continue
+            d: dict[str, list[Remark]] = collections.defaultdict(list)
             for remark in cur_line_remarks:
-                if len(d[remark.Name]) < 5:
-                    d[remark.Name].append(remark)
-                else:
-                    count_deleted[remark.Name] += 1
+                d[remark.Name].append(remark)
+            count_deleted = {name: len(keys) for name, keys in cur_line_remarks.omitted.items()}
 
             for obj_name, remarks in d.items():
                 # render caret line, if all rendered remarks share a column
@@ -95,7 +108,7 @@ def render_file_source(source_dir: str, output_dir: str, filename: str,
                            ]
                 for remark in remarks:
                     yield render_inline_remark(remark, html_line)
-                if count_deleted[obj_name] != 0:
+                if count_deleted.get(obj_name, 0) != 0:
                     yield ['',
                            0,
                            {'class': "column-entry-yellow", 'text': ''},
@@ -138,22 +151,21 @@ def render_file_source(source_dir: str, output_dir: str, filename: str,
                 {'class': "column-entry-yellow", 'text': inlining_context},
                 ]
 
-    with open(html_filename, "w", encoding='utf-8') as f:
-        if not os.path.exists(filename):
-            f.write(f'''
+    if not os.path.exists(filename):
+        f.write(f'''
     <html>
     <h1>Unable to locate file {filename}</h1>
 </html>''')
-            return
+        return
 
-        try:
-            with open(filename, encoding="utf8", errors='ignore') as source_stream:
-                entries = list(render_source_lines(source_stream, line_remarks))
-        except Exception:
-            print(f"Failed to process file {filename}")
-            raise
+    try:
+        with open(filename, encoding="utf8", errors='ignore') as source_stream:
+            entries = list(render_source_lines(source_stream, line_remarks))
+    except Exception:
+        print(f"Failed to process file {filename}")
+        raise
 
-        f.write(f'''
+    f.write(f'''
 <html>
 <meta charset="utf-8" />
 <head>
@@ -232,23 +244,33 @@ $(document).ready(function() {{
 ''')
 
 
-def render_index(output_dir: str, all_remarks: list[Remark]) -> str:
-    def render_entry(remark: Remark):
+def render_file_source(source_dir: str, output_dir: str, filename: str,
+                       line_remarks: DictLine2Remarks):
+    html_filename = os.path.join(output_dir, html_file_name(filename))
+    with open(html_filename, "w", encoding='utf-8') as f:
+        write_file_source(f, source_dir, filename, line_remarks)
+
+
+def write_index(f: IO, groups: list[LocationGroup], num_search_shards: int):
+    def render_entry(group: LocationGroup):
+        remark = group.remark
+        function_name = remark.demangled_func_name
+        if len(group.functions) > 1:
+            function_name += f" (+{len(group.functions) - 1} more)"
         return dict(description=remark.Name,
                     loc=f"<a href={remark.Link}>{remark.debug_loc_string}</a>",
                     message=remark.message,
-                    functionName=remark.demangled_func_name,
-                    relativeHotness=remark.RelativeHotness,
+                    functionName=function_name,
+                    count=group.count,
+                    relativeHotness=group.RelativeHotness,
                     color=remark.color)
 
-    entries = [render_entry(remark) for remark in all_remarks]
+    entries = [render_entry(group) for group in groups]
 
     entries_summary = collections.Counter(e['description'] for e in entries)
     entries_summary_li = '\n'.join(f"<li>{key}: {value}" for key, value in entries_summary.items())
 
-    index_path = os.path.join(output_dir, 'index.html')
-    with open(index_path, 'w', encoding='utf-8') as f:
-        f.write(f'''
+    f.write(f'''
 <html>
 <meta charset="utf-8" />
 <head>
@@ -258,6 +280,7 @@ def render_index(output_dir: str, all_remarks: list[Remark]) -> str:
 <script src="assets/jquery-3.5.1.js"></script>
 <script src="assets/jquery.dataTables.min.js"></script>
 <script src="assets/colResizable-1.6.min.js"></script>
+<script src="assets/optsearch.js"></script>
 <title>OptView2 Index</title>
 </head>
 <body>
@@ -265,20 +288,26 @@ def render_index(output_dir: str, all_remarks: list[Remark]) -> str:
 <ul id='entries_summary'>
 {entries_summary_li}
 </ul>
+<p><input id="search" type="search" placeholder="Search functions, messages, names, files"></p>
 <div class="centered">
 <table id="opt_table" class="" width="100%"></table>
 </div>
 <script type="text/javascript">
 var dataSet = {json.dumps(entries)};
 $(document).ready(function() {{
-    $('#opt_table').DataTable( {{
+    var table = $('#opt_table').DataTable( {{
         data: dataSet,
+        deferRender: true,
+        // Searching is done through the prebuilt index (optsearch.js), not by DataTables
+        dom: 'lrtip',
         "lengthMenu": [[100, 500, -1], [100, 500, "All"]],
+        "order": [],
         columns: [
             {{ title: "Location", data: "loc" }},
             {{ title: "Description", data: "description" }},
             {{ title: "Function", data: "functionName" }},
             {{ title: "Message", data: "message" }},
+            {{ title: "Remarks", data: "count" }},
             {{ title: "Hotness", data: "relativeHotness" }},
         ],
         columnDefs: [
@@ -291,88 +320,134 @@ $(document).ready(function() {{
         ]
     }} );
     $("#opt_table").colResizable()
+    optSearch.attach(document.getElementById('search'), {num_search_shards}, function(ids) {{
+        table.clear();
+        table.rows.add(ids === null ? dataSet : ids.map(function(id) {{ return dataSet[id]; }}));
+        table.draw();
+    }});
 }} );
 </script>
 </body>
 </html>
 ''')
-    return index_path
 
 
-def _render_file(source_dir: str, output_dir: str, ctx: Context,
-                 entry: tuple[str, dict[int, list[Remark]]]):
+# Tokens per search index shard, roughly - shards are loaded whole
+SEARCH_SHARD_TOKENS = 2000
+
+
+def search_tokens(text: str) -> set[str]:
+    # Must match tokenize() in assets/optsearch.js. Single characters are kept,
+    # for file names like a.h
+    return set(re.findall(r'[a-z0-9_]+', text.lower()))
+
+
+def search_shard_of(token: str, num_shards: int) -> int:
+    # Shard by the first two characters, so that a prefix query needs a single
+    # shard (a single character only matches itself, see optsearch.js)
+    return (ord(token[0]) * 128 + (ord(token[1]) if len(token) > 1 else 0)) % num_shards
+
+
+def build_search_index(groups: list[LocationGroup]) -> list[str]:
+    """
+    The inverted index searched by the index page: token -> ids (positions in
+    `groups`) of the rows whose file path, remark name, function name or
+    message contain it. Returned as shard scripts for assets/optsearch.js,
+    each a JSON object of delta encoded posting lists - deflated and base64
+    encoded.
+    """
+    postings: dict[str, list[int]] = collections.defaultdict(list)
+    for row, group in enumerate(groups):
+        remark = group.remark
+        text = ' '.join((remark.File, str(remark.Line), remark.Name, remark.demangled_func_name, remark.text()))
+        for token in search_tokens(text):
+            postings[token].append(row)
+
+    num_shards = max(1, min(256, len(postings) // SEARCH_SHARD_TOKENS))
+    shards: list[dict[str, list[int]]] = [dict() for _ in range(num_shards)]
+    for token, rows in sorted(postings.items()):
+        shards[search_shard_of(token, num_shards)][token] = [rows[0]] + [b - a for a, b in zip(rows, rows[1:])]
+
+    scripts = []
+    for shard_id, shard in enumerate(shards):
+        data = zlib.compress(json.dumps(shard, separators=(',', ':')).encode('utf-8'), 9)
+        scripts.append(f'optSearch.addShard({shard_id}, "{base64.b64encode(data).decode("ascii")}");\n')
+    return scripts
+
+
+def index_pages(groups: list[LocationGroup]) -> list[tuple[str, str]]:
+    """The index page and its search index shards, as (path, content) - the shards first"""
+    shards = build_search_index(groups)
+    pages = [(f"search/{shard_id}.js", script) for shard_id, script in enumerate(shards)]
+    index = io.StringIO()
+    write_index(index, groups, len(shards))
+    pages.append(('index.html', index.getvalue()))
+    return pages
+
+
+def render_index(output_dir: str, groups: list[LocationGroup]) -> str:
+    search_dir = pathlib.Path(output_dir) / 'search'
+    search_dir.mkdir(exist_ok=True)
+    # Shards of a previous index (e.g. while watching) that are not rewritten
+    stale = set(search_dir.iterdir())
+    for name, text in index_pages(groups):
+        path = pathlib.Path(output_dir) / name
+        path.write_text(text, encoding='utf-8')
+        stale.discard(path)
+    for path in stale:
+        path.unlink()
+    return os.path.join(output_dir, 'index.html')
+
+
+def _set_context(ctx: Context):
+    # Pool initializer: install the shared context once per worker process
     global context
     context = ctx
-    filename, remarks = entry
-    render_file_source(source_dir, output_dir, filename, remarks)
 
 
-def map_remarks(all_remarks: dict[RemarkKey, Remark]):
-    # Set up a map between function names and their source location for
-    # function where inlining happened
-    for remark in all_remarks.values():
-        if isinstance(remark, Passed) and remark.Pass == "inline" and remark.Name == "Inlined":
-            for arg in remark.Args:
-                arg_dict: dict[str, str] = dict(arg)
-                caller = arg_dict.get('Caller')
-                if caller:
-                    try:
-                        context.caller_loc[caller] = arg_dict['DebugLoc']
-                    except KeyError:
-                        pass
+def _render_file(source_dir: str, output_dir: str,
+                 entry: tuple[str, DictLine2Remarks]):
+    filename, remarks = entry
+    render_file_source(source_dir, output_dir, filename, remarks)
 
 
-def generate_report(all_remarks: dict[RemarkKey, Remark],
-                    file_remarks: DictFile2Remarks,
-                    source_dir: str,
-                    output_dir: str,
-                    should_display_hotness: bool,
-                    num_jobs: int = 1,
-                    open_browser: bool = False):
-    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
-
-    logging.info('Rendering index page...')
-    logging.info(f"  {len(all_remarks):d} raw remarks")
-    if len(all_remarks) == 0:
-        logging.warning("""Not generating report! Please verify your --source-dir argument is
-            exactly the path from which the compiler was invoked.""")
-        return
+def _render_file_page(source_dir: str, entry: tuple[str, DictLine2Remarks]) -> tuple[str, str]:
+    filename, remarks = entry
+    page = io.StringIO()
+    write_file_source(page, source_dir, filename, remarks)
+    return html_file_name(filename), page.getvalue()
 
-    sorted_remarks = sorted(all_remarks.values(),
-                            key=lambda r: (r.File, r.Line, r.Column, r.pass_with_diff_prefix))
-    unique_lines_remarks = [sorted_remarks[0]]
-    for rmk in sorted_remarks:
-        last_unq_rmk = unique_lines_remarks[-1]
-        last_rmk_key = (last_unq_rmk.File, last_unq_rmk.Line, last_unq_rmk.Column, last_unq_rmk.pass_with_diff_prefix)
-        rmk_key = (rmk.File, rmk.Line, rmk.Column, rmk.pass_with_diff_prefix)
-        if rmk_key != last_rmk_key:
-            unique_lines_remarks.append(rmk)
-    logging.info("  {:d} unique source locations".format(len(unique_lines_remarks)))
 
+def sort_index_groups(groups: list[LocationGroup], should_display_hotness: bool) -> list[LocationGroup]:
+    # Groups are unique per location, so this is the only sort needed
     if should_display_hotness:
-        sorted_remarks = sorted(unique_lines_remarks,
-                                key=lambda r: (r.Hotness, r.File, r.Line, r.Column,
-                                               r.pass_with_diff_prefix, r.yaml_tag, r.Function),
-                                reverse=True)
+        return sorted(groups,
+                      key=lambda g: (g.hotness, g.remark.File, g.remark.Line, g.remark.Column,
+                                     g.remark.pass_with_diff_prefix),
+                      reverse=True)
     else:
-        sorted_remarks = sorted(unique_lines_remarks,
-                                key=lambda r:
-                                    (r.File, r.Line, r.Column, r.pass_with_diff_prefix, r.yaml_tag, r.Function))
+        return sorted(groups,
+                      key=lambda g: (g.remark.File, g.remark.Line, g.remark.Column, g.remark.pass_with_diff_prefix))
 
-    index_path = render_index(output_dir, sorted_remarks)
 
+def asset_files() -> list[str]:
+    return glob.glob(os.path.join(str(pathlib.Path(os.path.realpath(__file__)).parent), "assets", '*.*'))
+
+
+def copy_assets(output_dir: str):
     logging.info("Copying assets")
     assets_path = pathlib.Path(output_dir) / "assets"
     assets_path.mkdir(parents=True, exist_ok=True)
-    for filename in glob.glob(os.path.join(str(pathlib.Path(os.path.realpath(__file__)).parent), "assets", '*.*')):
+    for filename in asset_files():
         shutil.copy(filename, assets_path)
 
-    _render_file_bound = functools.partial(_render_file, source_dir, output_dir, context)
-    logging.info('Rendering HTML files...')
-    optpmap.parallel_map(func=_render_file_bound,
-                         iterable=file_remarks.items(),
-                         processes=num_jobs)
 
+def archive_done(archive: str):
+    logging.info(f'Done - serve the report with: {os.path.join(os.path.dirname(__file__), "optarchive.py")} '
+                 f'{archive} --open-browser')
+
+
+def report_done(index_path: str, open_browser: bool):
     url_path = f'file://{os.path.abspath(index_path)}'
     logging.info(f'Done - check the index page at {url_path}')
     if open_browser:
@@ -386,13 +461,327 @@ def generate_report(all_remarks: dict[RemarkKey, Remark],
             pass
 
 
+def generate_report(all_remarks: dict[RemarkKey, Remark],
+                    file_remarks: DictFile2Remarks,
+                    source_dir: str,
+                    output_dir: str,
+                    should_display_hotness: bool,
+                    num_jobs: int = 1,
+                    open_browser: bool = False,
+                    archive: str | None = None):
+    """
+    Render the report into `output_dir` - or, if `archive` is given, into
+    that single zip file instead (see optarchive.py).
+    """
+    if not archive:
+        pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    logging.info('Rendering index page...')
+    logging.info(f"  {num_unique_remarks(file_remarks):d} raw remarks")
+    if len(all_remarks) == 0:
+        logging.warning("""Not generating report! Please verify your --source-dir argument is
+            exactly the path from which the compiler was invoked.""")
+        return
+
+    groups = group_locations(all_remarks, file_remarks)
+    logging.info("  {:d} unique source locations".format(len(groups)))
+
+    sorted_groups = sort_index_groups(groups, should_display_hotness)
+
+    if archive:
+        with ReportArchive(archive) as report:
+            for name, text in index_pages(sorted_groups):
+                report.write(name, text)
+            report.add_files(asset_files(), 'assets')
+
+            # Pages are streamed from the render workers into the single archive writer
+            logging.info('Rendering HTML files...')
+            for name, page in optpmap.parallel_imap(func=functools.partial(_render_file_page, source_dir),
+                                                    iterable=file_remarks.items(),
+                                                    processes=num_jobs,
+                                                    initializer=_set_context,
+                                                    initargs=(context,)):
+                report.write(name, page)
+        archive_done(archive)
+        return
+
+    index_path = render_index(output_dir, sorted_groups)
+
+    copy_assets(output_dir)
+
+    # The context (notably caller_loc) is shared by all files - ship it to each
+    # worker once through the pool initializer rather than with every task.
+    _render_file_bound = functools.partial(_render_file, source_dir, output_dir)
+    logging.info('Rendering HTML files...')
+    optpmap.parallel_map(func=_render_file_bound,
+                         iterable=file_remarks.items(),
+                         processes=num_jobs,
+                         initializer=_set_context,
+                         initargs=(context,))
+
+    report_done(index_path, open_browser)
+
+
+def _render_partition(source_dir: str, output_dir: str | None, max_hotness: int, max_remarks_per_line: int,
+                      partition_dir: str) -> tuple[int, list[LocationGroup], list[tuple[str, str]]]:
+    # Without an output_dir, the rendered pages are returned instead of written
+    all_remarks, file_remarks = load_partition(partition_dir, max_hotness, max_remarks_per_line)
+    pages = []
+    for entry in file_remarks.items():
+        if output_dir:
+            _render_file(source_dir, output_dir, entry)
+        else:
+            pages.append(_render_file_page(source_dir, entry))
+    if not all_remarks:
+        return 0, [], pages
+    return num_unique_remarks(file_remarks), group_locations(all_remarks, file_remarks), pages
+
+
+def generate_partitioned_report(spill_dir: str,
+                                num_partitions: int,
+                                max_hotness: int,
+                                source_dir: str,
+                                output_dir: str,
+                                num_jobs: int = 1,
+                                open_browser: bool = False,
+                                archive: str | None = None,
+                                max_remarks_per_line: int = 5):
+    """
+    Out-of-core counterpart of generate_report, for remarks spilled by
+    spill_results. Each partition is loaded, deduplicated and rendered on its
+    own, so memory is bounded by the largest partition; only the index
+    entries (one remark per unique location) are collected for the global
+    index page.
+    """
+    if archive:
+        report = ReportArchive(archive)
+    else:
+        pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    _render_partition_bound = functools.partial(_render_partition, source_dir,
+                                                None if archive else output_dir, max_hotness,
+                                                max_remarks_per_line)
+    logging.info('Rendering HTML files...')
+    num_remarks = 0
+    groups: list[LocationGroup] = []
+    try:
+        for num_remarks_job, groups_job, pages in optpmap.parallel_imap(
+                func=_render_partition_bound,
+                iterable=partition_dirs(spill_dir, num_partitions),
+                processes=num_jobs,
+                initializer=_set_context,
+                initargs=(context,)):
+            num_remarks += num_remarks_job
+            groups.extend(groups_job)
+            for name, page in pages:
+                report.write(name, page)
+
+        logging.info('Rendering index page...')
+        logging.info(f"  {num_remarks:d} raw remarks")
+        if num_remarks == 0:
+            logging.warning("""Not generating report! Please verify your --source-dir argument is
+                exactly the path from which the compiler was invoked.""")
+            if archive:
+                report.discard()
+            return
+        logging.info("  {:d} unique source locations".format(len(groups)))
+
+        sorted_groups = sort_index_groups(groups, max_hotness != 0)
+
+        if archive:
+            for name, text in index_pages(sorted_groups):
+                report.write(name, text)
+            report.add_files(asset_files(), 'assets')
+            report.close()
+            archive_done(archive)
+            return
+    except BaseException:
+        if archive:
+            report.discard()
+        raise
+
+    index_path = render_index(output_dir, sorted_groups)
+
+    copy_assets(output_dir)
+
+    report_done(index_path, open_browser)
+
+
+# With --watch, rewriting the (whole) index takes at most about 1/(1 + this)
+# of the time while records keep coming in
+WATCH_INDEX_BACKOFF = 4
+
+
+def _index_row(group: LocationGroup) -> tuple:
+    # What the index shows of a group, to tell whether it must be rewritten
+    return group.remark.key, group.count, frozenset(group.functions), group.hotness
+
+
+def _try_get_remarks(filter_args: tuple, input_file: str) -> tuple[str, tuple | None]:
+    try:
+        return input_file, get_remarks(input_file, *filter_args)
+    except Exception as ex:
+        # Most likely a record the compiler is still writing - it will show up again once complete
+        logging.warning(f"Failed to parse {input_file}: {ex}")
+        return input_file, None
+
+
+def _render_file_with_callers(source_dir: str, output_dir: str, caller_loc: dict[str, tuple],
+                              entry: tuple[str, DictLine2Remarks]):
+    # The caller map keeps growing while watching, so each task carries the
+    # (small) part of it relevant to its file instead of a pool-wide context
+    context.caller_loc = caller_loc
+    _render_file(source_dir, output_dir, entry)
+
+
+def watch_report(dirs: list[str],
+                 source_dir: str,
+                 output_dir: str,
+                 num_jobs: int | None = None,
+                 interval: float = 1.0,
+                 idle_timeout: float = 0,
+                 open_browser: bool = False,
+                 filter_args: tuple = (),
+                 max_remarks_per_line: int = 5,
+                 sample_profile: SampleProfile | None = None):
+    """
+    Keep the report under `output_dir` up to date while the build writes
+    optimization records under `dirs`.
+
+    A single worker pool stays alive throughout. Every batch of new or
+    modified records is parsed as it appears, and only the source pages
+    they touch are re-rendered (all of them if the global max hotness
+    changed). The index is rewritten whole, so while records keep coming in
+    it is rewritten at most every WATCH_INDEX_BACKOFF times as long as the
+    last rewrite took - and as soon as no record changed for `interval`
+    seconds. Runs until interrupted, or until no record changed for
+    `idle_timeout` seconds.
+    """
+    from optwatch import watch_opt_files
+
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    copy_assets(output_dir)
+    index_path = os.path.join(output_dir, 'index.html')
+
+    # Per record file: its parsed remarks, by source file and line
+    record_remarks: dict[str, DictFile2Remarks] = dict()
+    record_max_hotness: dict[str, int] = dict()
+    # Per source file: the record files with remarks for it, and its merged state
+    source_records: dict[str, set[str]] = collections.defaultdict(set)
+    source_remarks: dict[str, DictLine2Remarks] = dict()
+    source_groups: dict[str, list[LocationGroup]] = dict()
+    # Per function: the source files with remarks in it, whose inline context links depend on its location
+    function_sources: dict[str, set[str]] = collections.defaultdict(set)
+    max_hotness = 0
+    # Whether the index is out of date, and when it may be rewritten next
+    index_changed = False
+    next_index_time = 0.0
+
+    def write_index_if_due(force: bool):
+        nonlocal index_changed, next_index_time
+        if not index_changed or (not force and time.monotonic() < next_index_time):
+            return
+        groups = [group for groups_source in source_groups.values() for group in groups_source]
+        if groups or os.path.exists(index_path):
+            start = time.monotonic()
+            render_index(output_dir, sort_index_groups(groups, max_hotness != 0))
+            end = time.monotonic()
+            next_index_time = end + WATCH_INDEX_BACKOFF * (end - start)
+            logging.info(f"Wrote the index of {len(groups)} unique source locations in {end - start:.2f}s")
+        index_changed = False
+
+    pool = multiprocessing.Pool(processes=num_jobs, initializer=set_sample_profile, initargs=(sample_profile,))
+    try:
+        for batch in watch_opt_files(dirs, interval, idle_timeout, idle_batches=True):
+            if not batch:
+                write_index_if_due(force=True)
+                continue
+            start_time = datetime.now()
+            parsed = pool.map(functools.partial(_try_get_remarks, (*filter_args, max_remarks_per_line)), batch)
+
+            affected: set[str] = set()
+            for input_file, result in parsed:
+                if result is None:
+                    continue
+                max_hotness_job, all_remarks_job, file_remarks_job, _, function_locs_job = result
+                affected.update(record_remarks.get(input_file, {}))
+                for source in record_remarks.get(input_file, {}):
+                    source_records[source].discard(input_file)
+                affected.update(file_remarks_job)
+                for source in file_remarks_job:
+                    source_records[source].add(input_file)
+                record_remarks[input_file] = file_remarks_job
+                record_max_hotness[input_file] = max_hotness_job
+                for remark in all_remarks_job.values():
+                    function_sources[remark.Function].add(remark.File)
+
+                for function, loc in function_locs_job.items():
+                    if context.caller_loc.get(function) != loc:
+                        context.caller_loc[function] = loc
+                        affected.update(function_sources[function])
+
+            new_max_hotness = max(record_max_hotness.values(), default=0)
+            if new_max_hotness != max_hotness:
+                index_changed = True
+                # Relative hotness changed everywhere
+                max_hotness = new_max_hotness
+                affected.update(source_records)
+
+            # Re-merge the affected sources, like gather_results does globally
+            for source in affected:
+                all_remarks: dict[RemarkKey, Remark] = dict()
+                merged = new_file_remarks()
+                for input_file in sorted(source_records[source]):
+                    merge_file_remarks({source: record_remarks[input_file][source]}, all_remarks, merged,
+                                       max_hotness, max_remarks_per_line)
+                old_groups = source_groups.get(source, [])
+                if all_remarks:
+                    source_remarks[source] = merged[source]
+                    source_groups[source] = group_locations(all_remarks, merged)
+                else:
+                    # No remarks left - the page would not be generated at all
+                    source_remarks.pop(source, None)
+                    source_groups.pop(source, None)
+                    pathlib.Path(output_dir, html_file_name(source)).unlink(missing_ok=True)
+                new_groups = source_groups.get(source, [])
+                if [_index_row(g) for g in old_groups] != [_index_row(g) for g in new_groups]:
+                    index_changed = True
+
+            entries = []
+            for source in sorted(affected & source_remarks.keys()):
+                line_remarks = source_remarks[source]
+                functions = {remark.Function for remarks in line_remarks.values() for remark in remarks}
+                caller_loc = {function: context.caller_loc[function]
+                              for function in functions if function in context.caller_loc}
+                entries.append((caller_loc, (source, line_remarks)))
+            pool.starmap(functools.partial(_render_file_with_callers, source_dir, output_dir), entries)
+
+            logging.info(f"Parsed {len(batch)} record files, rendered {len(entries)} source files "
+                         f"in {datetime.now() - start_time}")
+            write_index_if_due(force=False)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching")
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+    write_index_if_due(force=True)
+
+    if os.path.exists(index_path):
+        report_done(index_path, open_browser)
+
+
 def main():
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument(
         'yaml_dirs_or_files',
-        nargs='+',
+        nargs='*',
         help='List of optimization record files or directories searched '
              'for optimization record files.')
+    parser.add_argument(
+        '--manifest',
+        help='Read the optimization record files to process from this file instead of searching '
+             'directories: either a compile_commands.json or a list of paths, one per line')
     parser.add_argument(
         '--output-dir',
         '-o',
@@ -400,6 +789,11 @@ def main():
         help='Path to a directory where generated HTML files will be output. '
              'If the directory does not already exist, it will be created. '
              '"%(default)s" by default.')
+    parser.add_argument(
+        '--output-archive',
+        default=None,
+        help='''Write the whole report into this single zip file instead of --output-dir - one large
+            write instead of a file per page. Serve it with optarchive.py''')
     parser.add_argument(
         '--jobs',
         '-j',
@@ -419,24 +813,44 @@ def main():
 
     parser.add_argument(
         '--exclude-name',
+        dest='exclude_names',
         default='',
         help='Omit optimization remarks with names matched by this regex')
 
     parser.add_argument(
         '--exclude-text',
         default='',
-        help='Omit optimization remarks with names matched by this regex')
+        help='''Omit optimization remarks with text matched by this regex - the plain message text,
+            with demangled names''')
+
+    parser.add_argument(
+        '--exclude-text-raw',
+        action='store_true',
+        help='Match --exclude-text against mangled function names, skipping the demangler')
 
     parser.add_argument(
         '--collect-opt-success',
         action='store_true',
         help='Collect all optimization remarks, not just failures')
 
+    parser.add_argument(
+        '--max-remarks-per-line',
+        type=int,
+        help='''Display at most this many remarks of each name on a source line, and just count the
+            rest (0 for no limit). Applied while gathering, so omitted remarks cost no memory''')
+
     parser.add_argument(
         '--annotate-external',
         action='store_true',
         help='Annotate all files, including system headers')
 
+    parser.add_argument(
+        '--sample-profile',
+        default=None,
+        help='''Rank remarks by the CPU samples in this file, e.g. for builds without PGO: `perf script`
+            output (with -F +srcline for per-line samples), folded stacks (stackcollapse-perf.pl
+            output), or "file:line count" lines''')
+
     parser.add_argument(
         '--open-browser',
         action='store_true',
@@ -446,10 +860,65 @@ def main():
         '--split-top-folders',
         action='store_true',
         help='''Operate separately on every top level subfolder containing opt files -
-            to workaround out-of-memory crashes''')
+            to workaround out-of-memory crashes. Prefer --partitions, which produces a single report''')
 
-    if platform.system() == 'Darwin':  # macOs
-        multiprocessing.set_start_method('fork')
+    parser.add_argument(
+        '--partitions',
+        default=0,
+        type=int,
+        help='''Process remarks out of core, to bound memory usage on large builds: spill them
+            to this many on-disk partitions (by source file) and render each partition separately.
+            0 (the default) keeps everything in memory''')
+
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='''Keep running, and update the report as optimization records are written under
+            the given directories - e.g. while the project is being built''')
+
+    parser.add_argument(
+        '--watch-interval',
+        default=1.0,
+        type=float,
+        help='With --watch: seconds between checks for new records (defaults to %(default)s)')
+
+    parser.add_argument(
+        '--watch-idle-timeout',
+        default=0,
+        type=float,
+        help='''With --watch: stop after this many seconds without new records
+            (defaults to %(default)s - run until interrupted)''')
+
+    parser.add_argument(
+        '--check',
+        metavar='BUDGET',
+        default=None,
+        help='''Don't generate a report - count the remarks per (file, name, function) and compare
+            them against this budget file. Prints the entries over budget, and exits with an error
+            if there are any. For CI''')
+
+    parser.add_argument(
+        '--check-by-dir',
+        action='store_true',
+        help='With --check: count remarks per source directory instead of per file')
+
+    parser.add_argument(
+        '--update-budget',
+        action='store_true',
+        help='With --check: write the current remark counts to the budget file instead of checking')
+
+    parser.add_argument(
+        '--spill-dir',
+        default=None,
+        help='Directory for the --partitions spill files (defaults to a temporary directory)')
+
+    parser.add_argument(
+        '--start-method',
+        choices=multiprocessing.get_all_start_methods(),
+        default=None,
+        help='''How worker processes are started (defaults to the platform's default, fork on macOS). forkserver
+            forks workers from a server that has already imported the parsing and highlighting modules: about as
+            fast as fork, and much faster than spawn where fork is unavailable or unsafe''')
 
     # Do not make this a global variable.  Values needed to be propagated through
     # to individual classes and functions to be portable with multiprocessing across
@@ -460,6 +929,19 @@ def main():
         config = config_parser.parse(config_file)
     parser.set_defaults(**config)
     args = parser.parse_args()
+    if not args.yaml_dirs_or_files and not args.manifest:
+        parser.error("Either yaml_dirs_or_files or --manifest is required")
+
+    if args.start_method == 'forkserver':
+        multiprocessing.set_forkserver_preload(['__main__', 'optrecord', 'pygments.lexers.c_cpp',
+                                                'pygments.formatters'])
+    if args.start_method:
+        multiprocessing.set_start_method(args.start_method)
+    elif platform.system() == 'Darwin':  # macOs
+        multiprocessing.set_start_method('fork')
+
+    if not have_libyaml:
+        logging.warning("For faster parsing, you may want to install libYAML for PyYAML")
 
     source_dir = os.path.abspath(args.source_dir)
 
@@ -468,7 +950,43 @@ def main():
 
     start_time = datetime.now()
 
-    if args.split_top_folders:
+    sample_profile = SampleProfile.read(args.sample_profile) if args.sample_profile else None
+
+    if args.output_archive and (args.watch or args.split_top_folders):
+        parser.error("--output-archive is not supported with --watch or --split-top-folders")
+
+    if (args.update_budget or args.check_by_dir) and not args.check:
+        parser.error("--update-budget and --check-by-dir require --check")
+
+    if args.check and not args.update_budget and not os.path.isfile(args.check):
+        parser.error(f"Budget file {args.check} not found - create it with --update-budget")
+
+    if args.check:
+        paths = list(args.yaml_dirs_or_files)
+        if args.manifest:
+            paths.extend(read_manifest(args.manifest))
+        remark_filter = RemarkFilter(args.exclude_names, args.exclude_text, args.collect_opt_success,
+                                     args.annotate_external, not args.exclude_text_raw)
+        passed = run_check(paths, args.check, remark_filter, args.jobs,
+                           by_dir=args.check_by_dir, update=args.update_budget)
+        logging.info(f"Ran for {datetime.now() - start_time}")
+        sys.exit(0 if passed else 1)
+
+    if args.watch:
+        if not args.yaml_dirs_or_files:
+            parser.error("--watch requires directories to watch")
+        watch_report(dirs=args.yaml_dirs_or_files,
+                     source_dir=source_dir,
+                     output_dir=args.output_dir,
+                     num_jobs=args.jobs,
+                     interval=args.watch_interval,
+                     idle_timeout=args.watch_idle_timeout,
+                     open_browser=args.open_browser,
+                     filter_args=(args.exclude_names, args.exclude_text, args.collect_opt_success,
+                                  args.annotate_external, not args.exclude_text_raw),
+                     max_remarks_per_line=args.max_remarks_per_line,
+                     sample_profile=sample_profile)
+    elif args.split_top_folders:
         subfolders = []
         for item in os.listdir(args.yaml_dirs_or_files[0]):
             if os.path.isfile(os.path.join(args.yaml_dirs_or_files[0], item)):
@@ -482,14 +1000,17 @@ def main():
 
             logging.info(f"Processing subfolder {subfolder}")
 
-            all_remarks, file_remarks, should_display_hotness = \
+            all_remarks, file_remarks, should_display_hotness, function_locs = \
                 gather_results(filenames=files, num_jobs=args.jobs,
                                exclude_names=args.exclude_names,
                                exclude_text=args.exclude_text,
                                collect_opt_success=args.collect_opt_success,
-                               annotate_external=args.annotate_external)
+                               annotate_external=args.annotate_external,
+                               demangle_text=not args.exclude_text_raw,
+                               max_remarks_per_line=args.max_remarks_per_line,
+                               sample_profile=sample_profile)
 
-            map_remarks(all_remarks)
+            context.caller_loc.update(function_locs)
 
             generate_report(all_remarks=all_remarks,
                             file_remarks=file_remarks,
@@ -499,27 +1020,62 @@ def main():
                             num_jobs=args.jobs,
                             open_browser=args.open_browser)
     else:  # not split_top_foders
-        files = find_opt_files(os.path.join(*args.yaml_dirs_or_files))
-        if not files:
+        # Discovery runs lazily: files are handed to the parse workers as they are found.
+        files = iter_opt_files(*args.yaml_dirs_or_files)
+        if args.manifest:
+            files = itertools.chain(read_manifest(args.manifest), files)
+        first_file = next(files, None)
+        if first_file is None:
             parser.error("No *.opt.yaml files found")
             sys.exit(1)
+        files = itertools.chain([first_file], files)
+
+        if args.partitions > 0:
+            pathlib.Path(args.spill_dir or tempfile.gettempdir()).mkdir(parents=True, exist_ok=True)
+            with tempfile.TemporaryDirectory(prefix='optview2-', dir=args.spill_dir) as spill_dir:
+                max_hotness, function_locs = \
+                    spill_results(filenames=files, spill_dir=spill_dir, num_partitions=args.partitions,
+                                  num_jobs=args.jobs,
+                                  exclude_names=args.exclude_names,
+                                  exclude_text=args.exclude_text,
+                                  collect_opt_success=args.collect_opt_success,
+                                  annotate_external=args.annotate_external,
+                                  demangle_text=not args.exclude_text_raw,
+                                  max_remarks_per_line=args.max_remarks_per_line,
+                                  sample_profile=sample_profile)
+
+                context.caller_loc.update(function_locs)
+
+                generate_partitioned_report(spill_dir=spill_dir,
+                                            num_partitions=args.partitions,
+                                            max_hotness=max_hotness,
+                                            source_dir=source_dir,
+                                            output_dir=args.output_dir,
+                                            num_jobs=args.jobs,
+                                            open_browser=args.open_browser,
+                                            archive=args.output_archive,
+                                            max_remarks_per_line=args.max_remarks_per_line)
+        else:
+            all_remarks, file_remarks, should_display_hotness, function_locs = \
+                gather_results(filenames=files, num_jobs=args.jobs,
+                               exclude_names=args.exclude_names,
+                               exclude_text=args.exclude_text,
+                               collect_opt_success=args.collect_opt_success,
+                               annotate_external=args.annotate_external,
+                               demangle_text=not args.exclude_text_raw,
+                               max_remarks_per_line=args.max_remarks_per_line,
+                               sample_profile=sample_profile)
 
-        all_remarks, file_remarks, should_display_hotness = \
-            gather_results(filenames=files, num_jobs=args.jobs,
-                           exclude_names=args.exclude_names,
-                           exclude_text=args.exclude_text,
-                           collect_opt_success=args.collect_opt_success,
-                           annotate_external=args.annotate_external)
-
-        map_remarks(all_remarks)
-
-        generate_report(all_remarks=all_remarks,
-                        file_remarks=file_remarks,
-                        source_dir=source_dir,
-                        output_dir=args.output_dir,
-                        should_display_hotness=should_display_hotness,
-                        num_jobs=args.jobs,
-                        open_browser=args.open_browser)
+            context.caller_loc.update(function_locs)
+
+            generate_report(all_remarks=all_remarks,
+                            file_remarks=file_remarks,
+                            source_dir=source_dir,
+                            output_dir=args.output_dir,
+                            should_display_hotness=should_display_hotness,
+                            num_jobs=args.jobs,
+                            open_browser=args.open_browser,
+                            archive=args.output_archive)
 
     end_time = datetime.now()
     logging.info(f"Ran for {end_time - start_time}")
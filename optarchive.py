@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import argparse
+import logging
+import os
+import posixpath
+import zipfile
+
+desc = '''Serve an optview2 report archive (generated with opt-viewer.py --output-archive)
+over HTTP, straight out of the archive.'''
+
+
+class ReportArchive:
+    """
+    A whole report - pages, index and assets - written into a single zip
+    file through one writer, instead of a file per page.
+
+    The archive is written next to its final path and moved into place when
+    closed, so a published archive is never partially written.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.zip = zipfile.ZipFile(self.tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    def write(self, name: str, text: str):
+        self.zip.writestr(name, text.encode('utf-8'))
+
+    def add_files(self, filenames: list[str], dir: str):
+        for filename in filenames:
+            self.zip.write(filename, posixpath.join(dir, os.path.basename(filename)))
+
+    def close(self):
+        if self.zip.fp is None:  # Already closed or discarded
+            return
+        self.zip.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        if self.zip.fp is None:
+            return
+        self.zip.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self) -> ReportArchive:
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def serve(archive: str, port: int = 8000, bind: str = '127.0.0.1', open_browser: bool = False):
+    # Only needed to serve - opt-viewer imports this module just to write archives
+    import http.server
+    import mimetypes
+    import urllib.parse
+
+    report = zipfile.ZipFile(archive)
+    names = set(report.namelist())
+
+    class ArchiveRequestHandler(http.server.BaseHTTPRequestHandler):
+        def send_member(self, with_body: bool):
+            name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/') or 'index.html'
+            if name not in names:
+                self.send_error(404)
+                return
+            data = report.read(name)
+            self.send_response(200)
+            self.send_header('Content-Type', mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if with_body:
+                self.wfile.write(data)
+
+        def do_GET(self):
+            self.send_member(with_body=True)
+
+        def do_HEAD(self):
+            self.send_member(with_body=False)
+
+    # Single-threaded on purpose: reads from the ZipFile are not thread safe
+    with http.server.HTTPServer((bind, port), ArchiveRequestHandler) as server:
+        url_path = f'http://{bind}:{server.server_address[1]}/index.html'
+        logging.info(f'Serving {archive} at {url_path}')
+        if open_browser:
+            import webbrowser
+            webbrowser.open(url_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('archive', help='Report archive to serve')
+    parser.add_argument('--port', '-p', default=8000, type=int, help='Port to listen on (defaults to %(default)s)')
+    parser.add_argument('--bind', default='127.0.0.1', help='Address to listen on (defaults to %(default)s)')
+    parser.add_argument('--open-browser', action='store_true', help='Open browser at the served report')
+    args = parser.parse_args()
+    serve(args.archive, args.port, args.bind, args.open_browser)
+
+
+if __name__ == '__main__':
+    main()
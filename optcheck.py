@@ -0,0 +1,89 @@
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+from typing import TYPE_CHECKING
+from optrecord import Remark, RemarkFilter, group_by, iter_remarks
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+    from optrecord import RemarkRecord
+
+# (file or directory, remark Name, mangled Function)
+CountKey = tuple[str, str, str]
+
+
+def _unique(records: Iterable[RemarkRecord]) -> Iterator[RemarkRecord]:
+    # iter_remarks only deduplicates within a record file - remarks in headers
+    # show up once per including TU. Keep a 128-bit digest of each record
+    # seen: much smaller than the record, and - unlike hash() - collisions
+    # would not silently drop remarks from the counts.
+    seen: set[bytes] = set()
+    for record in records:
+        # repr() rather than pickle: equal records always give the same bytes
+        digest = hashlib.blake2b(repr(tuple(record)).encode('utf-8'), digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            yield record
+
+
+def count_remarks(paths: Iterable[str], remark_filter: RemarkFilter, num_jobs: int | None,
+                  by_dir: bool = False) -> dict[CountKey, int]:
+    """Count the unique remarks under `paths` per (file - or its directory, with `by_dir` - Name, Function)"""
+    if by_dir:
+        def key(r: RemarkRecord) -> CountKey:
+            return os.path.dirname(r.File), r.Name, r.Function
+    else:
+        def key(r: RemarkRecord) -> CountKey:
+            return r.File, r.Name, r.Function
+    groups = group_by(_unique(iter_remarks(paths, remark_filter, num_jobs)), key)
+    return {k: group.count for k, group in groups.items()}
+
+
+def read_budget(budget_file: str) -> dict[CountKey, int]:
+    with open(budget_file, encoding='utf-8') as f:
+        budget = json.load(f)
+    return {(entry['file'], entry['name'], entry['function']): entry['count'] for entry in budget['remarks']}
+
+
+def write_budget(budget_file: str, counts: dict[CountKey, int]):
+    # Sorted, one entry per line, so that budget updates review well as diffs
+    entries = [json.dumps({'file': file, 'name': name, 'function': function, 'count': count})
+               for (file, name, function), count in sorted(counts.items())]
+    with open(budget_file, 'w', encoding='utf-8') as f:
+        f.write('{"remarks": [\n' + ',\n'.join(entries) + '\n]}\n')
+
+
+def check_budget(counts: dict[CountKey, int], budget: dict[CountKey, int]) -> list[tuple[CountKey, int, int]]:
+    """The (key, budget, count) of every key with more remarks than budgeted - keys not in the budget have none"""
+    regressions = [(k, budget.get(k, 0), count) for k, count in counts.items() if count > budget.get(k, 0)]
+    return sorted(regressions)
+
+
+def run_check(paths: Iterable[str], budget_file: str, remark_filter: RemarkFilter, num_jobs: int | None,
+              by_dir: bool = False, update: bool = False) -> bool:
+    """
+    Compare the remark counts under `paths` against `budget_file`, printing
+    any regressions. Returns whether the check passed. With `update`, writes
+    the current counts to `budget_file` instead.
+    """
+    logging.info('Counting remarks...')
+    counts = count_remarks(paths, remark_filter, num_jobs, by_dir)
+    if update:
+        write_budget(budget_file, counts)
+        logging.info(f"Wrote {len(counts)} budget entries to {budget_file}")
+        return True
+
+    budget = read_budget(budget_file)
+    regressions = check_budget(counts, budget)
+    for (file, name, function), allowed, count in regressions:
+        print(f"{file}: {name} in {Remark.demangle(function)}: {count} remarks (budget {allowed})")
+
+    improved = sum(1 for k, allowed in budget.items() if counts.get(k, 0) < allowed)
+    if improved:
+        logging.info(f"{improved} budget entries have fewer remarks than budgeted - consider updating the budget")
+    if regressions:
+        logging.error(f"{len(regressions)} budget entries exceeded")
+        return False
+    logging.info('Remark budget check passed')
+    return True
@@ -1,9 +1,12 @@
 from __future__ import annotations
+import os
 import sys
+import itertools
 import multiprocessing
-from typing import TYPE_CHECKING, ItemsView, TypeVar, Any
+import queue
+from typing import TYPE_CHECKING, Iterable, TypeVar, Any
 if TYPE_CHECKING:
-    from collections.abc import Callable
+    from collections.abc import Callable, Iterator
     from multiprocessing.sharedctypes import Synchronized
 
 
@@ -11,11 +14,14 @@ _current: Synchronized[int]
 _total: Synchronized[int]
 
 
-def _init(current: Synchronized[int], total: Synchronized[int]):
+def _init(current: Synchronized[int], total: Synchronized[int],
+          initializer: Callable[..., object] | None = None, initargs: tuple[Any, ...] = ()):
     global _current
     global _total
     _current = current
     _total = total
+    if initializer is not None:
+        initializer(*initargs)
 
 
 T = TypeVar('T')
@@ -27,35 +33,150 @@ def _wrapped_func(func_and_args: tuple[Callable[..., T], *tuple[Any, ...]]) -> T
 
     with _current.get_lock():
         _current.value += 1
-    sys.stdout.write('\r\t{} of {}'.format(_current.value, _total.value))
+    if _total.value:
+        sys.stdout.write('\r\t{} of {}'.format(_current.value, _total.value))
+    else:
+        sys.stdout.write('\r\t{}'.format(_current.value))
     sys.stdout.flush()
 
     return func(*args)
 
-def parallel_map(func: Callable[..., T], iterable: ItemsView[Any, Any], processes: int, *args: object) -> list[T]:
+
+def _wrapped_chunk(chunk: list[tuple[Callable[..., T], *tuple[Any, ...]]]) -> list[T]:
+    return [_wrapped_func(func_and_args) for func_and_args in chunk]
+
+
+# Largest number of items per task when the input size is not known up
+# front. Workers are recycled every few tasks (maxtasksperchild), so tasks
+# must not stay tiny.
+LAZY_CHUNKSIZE = 64
+
+
+def _growing_chunks(iterable: Iterable[T], processes: int, max_size: int) -> Iterator[list[T]]:
+    # Hand every worker a single item first, then double the chunk size after
+    # each round of `processes` chunks: small inputs still spread over all
+    # workers, large ones soon go out in chunks of `max_size`
+    it = iter(iterable)
+    for num_chunks in itertools.count():
+        size = min(max_size, 1 << (num_chunks // processes))
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parallel_map(func: Callable[..., T], iterable: Iterable[Any], processes: int, *args: object,
+                 initializer: Callable[..., object] | None = None, initargs: tuple[Any, ...] = ()) -> list[T]:
     """
     A parallel map function that reports on its progress.
 
     Applies `func` to every item of `iterable` and return a list of the
     results. If `processes` is greater than one, a process pool is used to run
     the functions in parallel.
+
+    `iterable` may be a lazy iterator (no len()) - items are then handed to
+    the pool as they are produced, and progress is reported without a total.
+
+    `initializer(*initargs)` is run once in every worker before it picks up
+    tasks. Use it for large read-only state shared by all tasks, so it is
+    handed to each worker once instead of being pickled with every task.
+    """
+    return list(parallel_imap(func, iterable, processes, *args, initializer=initializer, initargs=initargs))
+
+
+def parallel_imap(func: Callable[..., T], iterable: Iterable[Any], processes: int, *args: object,
+                  initializer: Callable[..., object] | None = None,
+                  initargs: tuple[Any, ...] = ()) -> Iterator[T]:
+    """
+    Like parallel_map, but yields the results (in order) as they become
+    available, so the caller can consume them without holding all at once.
     """
     global _current
     global _total
     _current = multiprocessing.Value('i', 0)
-    _total = multiprocessing.Value('i', len(iterable))
+    sized = hasattr(iterable, '__len__')
+    _total = multiprocessing.Value('i', len(iterable) if sized else 0)  # type: ignore
 
-    func_and_args = [(func, it_arg, *args) for it_arg in iterable]
+    func_and_args = ((func, it_arg, *args) for it_arg in iterable)
     if processes == 1:
-        result: list[T] = list(map(_wrapped_func, func_and_args))
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(_wrapped_func, func_and_args)
     else:
         pool = multiprocessing.Pool(initializer=_init,
-                                    initargs=(_current, _total,),
+                                    initargs=(_current, _total, initializer, initargs),
                                     processes=processes,
                                     maxtasksperchild=2)
-        result = pool.map(_wrapped_func, func_and_args)
-        pool.close()
-        pool.join()
+        try:
+            if sized:
+                # Same chunking as Pool.map
+                chunksize, extra = divmod(_total.value, (processes or os.cpu_count() or 1) * 4)
+                if extra or not chunksize:
+                    chunksize += 1
+                yield from pool.imap(_wrapped_func, func_and_args, chunksize)
+            else:
+                # Chunk lazily, so items are still handed out as they are produced
+                chunks = _growing_chunks(func_and_args, processes or os.cpu_count() or 1, LAZY_CHUNKSIZE)
+                for results in pool.imap(_wrapped_chunk, chunks):
+                    yield from results
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
 
     sys.stdout.write('\n')
-    return result
+
+
+def parallel_imap_unordered(func: Callable[..., T], iterable: Iterable[Any], processes: int | None, *args: object,
+                            initializer: Callable[..., object] | None = None, initargs: tuple[Any, ...] = (),
+                            max_in_flight: int | None = None) -> Iterator[T]:
+    """
+    Like parallel_imap, but yields the results as the workers produce them,
+    in any order, and writes no progress. At most `max_in_flight` items (by
+    default, two per process) are taken from `iterable` and not yet yielded,
+    so neither the input nor the results pile up when the caller consumes
+    them more slowly than the workers produce them.
+    """
+    if processes == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in iterable:
+            yield func(item, *args)
+        return
+
+    processes = processes or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * processes
+    done: queue.SimpleQueue[tuple[bool, Any]] = queue.SimpleQueue()
+    pool = multiprocessing.Pool(processes=processes, initializer=initializer, initargs=initargs)
+    try:
+        items = iter(iterable)
+        in_flight = 0
+        exhausted = False
+        while True:
+            while not exhausted and in_flight < max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pool.apply_async(func, (item, *args),
+                                 callback=lambda result: done.put((True, result)),
+                                 error_callback=lambda ex: done.put((False, ex)))
+                in_flight += 1
+            if not in_flight:
+                break
+            ok, result = done.get()
+            in_flight -= 1
+            if not ok:
+                raise result
+            yield result
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
@@ -1,32 +1,37 @@
 #!/usr/bin/env python
 from __future__ import annotations
 import io
-from typing import TYPE_CHECKING, TypedDict
+from typing import TYPE_CHECKING, Any, Generic, NamedTuple, TypedDict, TypeVar, cast
 import yaml
 import platform
 import html
-from collections import defaultdict
-import fnmatch
+from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import functools
+import itertools
+import json
 from multiprocessing import Lock
 import os
+import pickle
 import subprocess
 import re
+import shlex
 from sys import intern
 import optpmap
 import logging
+import zlib
 if TYPE_CHECKING:
-    from collections.abc import Iterator
+    from collections.abc import Callable, Iterable, Iterator
     from multiprocessing.synchronize import Lock as LockType
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-
 try:
     # Try to use the C parser
     from yaml import CLoader as Loader
+    have_libyaml = True
 except ImportError:
-    logging.warning("For faster parsing, you may want to install libYAML for PyYAML")
+    # Not logged here - importing a library should not log; entry points report it
     from yaml import Loader  # type: ignore
+    have_libyaml = False
 
 
 def html_file_name(filename: str) -> str:
@@ -41,6 +46,18 @@ def make_link(file: str, line: int) -> str:
     return f'\'{html_file_name(file)}#L{line}\''
 
 
+# Entries kept by each of the per-process caches
+CACHE_LIMIT = 1 << 16
+
+
+def bounded_put(cache: dict, key, value):
+    # Start over once full, rather than let a long-lived process keep every
+    # name and message it ever saw
+    if len(cache) >= CACHE_LIMIT:
+        cache.clear()
+    cache[key] = value
+
+
 class EmptyLock(object):
     def __enter__(self) -> bool:
         return True
@@ -78,6 +95,13 @@ class Remark(yaml.YAMLObject):
     demangler_proc: subprocess.Popen | None = None
     demangler_lock: LockType | EmptyLock
 
+    # Per-process caches shared by all remarks. Identical Args tuples and
+    # function names recur across thousands of remarks, so each is rendered
+    # (and each name demangled) only once. Bounded (see bounded_put) - a
+    # --watch worker lives as long as the build.
+    rendered_messages: dict[tuple[tuple[str, ...]], str] = {}
+    demangled_names: dict[str, str] = {}
+
     @classmethod
     def open_demangler_proc(cls, demangler: str):
         cls.demangler_proc = subprocess.Popen(demangler.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
@@ -92,13 +116,18 @@ class Remark(yaml.YAMLObject):
 
     @classmethod
     def demangle(cls, name: str) -> str:
+        demangled = cls.demangled_names.get(name)
+        if demangled is not None:
+            return demangled
         if not cls.demangler_proc:
             cls.set_demangler(cls.default_demangler)
         assert cls.demangler_proc, "Unable to set demangler"
         with cls.demangler_lock:
             cls.demangler_proc.stdin.write((name + '\n').encode('utf-8'))  # type: ignore
             cls.demangler_proc.stdin.flush()  # type: ignore
-            return cls.demangler_proc.stdout.readline().rstrip().decode('utf-8')  # type: ignore
+            demangled = cls.demangler_proc.stdout.readline().rstrip().decode('utf-8')  # type: ignore
+        bounded_put(cls.demangled_names, name, demangled)
+        return demangled
 
     @property
     def color(self) -> str:
@@ -131,6 +160,10 @@ class Remark(yaml.YAMLObject):
 
         self.Args = tuple([_reduce_memory_dict(arg_dict) for arg_dict in self.Args])
 
+    def intern_args(self, interned_args: dict[tuple[tuple[str, ...]], tuple[tuple[str, ...]]]):
+        # Share a single instance between kept remarks with identical Args
+        self.Args = interned_args.setdefault(self.Args, self.Args)
+
     # The inverse operation of the dictonary-related memory optimization in
     # _reduce_memory_dict.  E.g.
     #     (('DebugLoc', (('File', ...) ... ))) -> [{'DebugLoc': {'File': ...} ....}]
@@ -176,7 +209,8 @@ class Remark(yaml.YAMLObject):
     def Link(self) -> str:  # noqa: N802
         return make_link(self.File, self.Line)
 
-    def getArgString(self, mapping):
+    @classmethod
+    def getArgString(cls, mapping):
         mapping = dict(list(mapping))
         dl = mapping.get('DebugLoc')
         if dl:
@@ -186,7 +220,7 @@ class Remark(yaml.YAMLObject):
         (key, value) = list(mapping.items())[0]
 
         if key == 'Caller' or key == 'Callee' or key == 'DirectCallee':
-            value = html.escape(self.demangle(value))
+            value = html.escape(cls.demangle(value))
 
         if dl and key != 'Caller':
             dl_dict = dict(list(dl))
@@ -195,6 +229,31 @@ class Remark(yaml.YAMLObject):
         else:
             return value
 
+    # Plain-text counterpart of getArgString: no HTML, no links. Used for
+    # filtering, where only the text matters.
+    @classmethod
+    def getArgText(cls, mapping, demangle: bool = True) -> str:
+        for (key, value) in mapping:
+            if key == 'DebugLoc':
+                continue
+            if demangle and (key == 'Caller' or key == 'Callee' or key == 'DirectCallee'):
+                return cls.demangle(value)
+            return str(value)
+        return ''
+
+    # Args naming a function (e.g. the Caller of an inlining remark) carry
+    # the location where that function is defined. Record them into
+    # `function_locs` - mangled name to DebugLoc, in the Args tuple form.
+    def collect_function_locs(self, function_locs: dict[str, tuple]):
+        for arg in self.Args:
+            mapping = dict(cast('tuple[tuple[str, Any], ...]', arg))
+            dl = mapping.pop('DebugLoc', None)
+            if dl is None or len(mapping) != 1:
+                continue
+            ((key, value),) = mapping.items()
+            if key == 'Caller' or key == 'Callee' or key == 'DirectCallee':
+                function_locs[value] = dl
+
     # Return a cached dictionary for the arguments.  The key for each entry is
     # the argument key (e.g. 'Callee' for inlining remarks.  The value is a
     # list containing the value (e.g. for 'Callee' the function) and
@@ -233,11 +292,24 @@ class Remark(yaml.YAMLObject):
     def pass_with_diff_prefix(self) -> str:
         return self.get_diff_prefix() + self.Pass
 
+    @classmethod
+    def render_message(cls, args) -> str:
+        # Args is a list of mappings (dictionaries)
+        if type(args) is not tuple:
+            # Not canonicalized (e.g. after recover_yaml_structure) - not hashable
+            return "".join([cls.getArgString(mapping) for mapping in args])
+        message = cls.rendered_messages.get(args)
+        if message is None:
+            message = "".join([cls.getArgString(mapping) for mapping in args])
+            bounded_put(cls.rendered_messages, args, message)
+        return message
+
     @property
     def message(self) -> str:
-        # Args is a list of mappings (dictionaries)
-        values = [self.getArgString(mapping) for mapping in self.Args]
-        return "".join(values)
+        return self.render_message(self.Args)
+
+    def text(self, demangle: bool = True) -> str:
+        return "".join([self.getArgText(mapping, demangle) for mapping in self.Args])
 
     @property
     def RelativeHotness(self) -> str:
@@ -262,10 +334,115 @@ class Remark(yaml.YAMLObject):
         return str(self.key)
 
 
-DictLine2Remarks = dict[int, list[Remark]]
+class _CapState:
+    """What a LineRemarks needs to enforce its cap - only lines that may reach it pay for this"""
+    __slots__ = ('omitted', 'index_only', 'counts', 'locations')
+
+    def __init__(self, remarks: list[Remark]):
+        self.omitted: dict[str, set[RemarkKey]] = {}
+        self.index_only: list[Remark] = []
+        self.counts: dict[str, int] = dict(Counter(remark.Name for remark in remarks))
+        self.locations: set[tuple[int, str]] = {(remark.Column, remark.pass_with_diff_prefix) for remark in remarks}
+
+
+_NO_OMITTED: dict[str, set[RemarkKey]] = {}
+
+
+class LineRemarks(list):
+    """
+    The remarks of a single source line, keeping at most `cap` remarks of
+    each Name (no limit if `cap` is 0) - only those are displayed. Of the
+    others, only the keys are kept, to deduplicate and count them; plus, so
+    the index is not affected, the first remark of every (Column, pass)
+    location on the line that would otherwise be lost.
+
+    Most lines have a remark or two: the bookkeeping for the cap is only
+    created once a line holds `cap` remarks.
+    """
+    __slots__ = ('cap_state',)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.cap_state: _CapState | None = None
+
+    @property
+    def omitted(self) -> dict[str, set[RemarkKey]]:
+        return self.cap_state.omitted if self.cap_state is not None else _NO_OMITTED
+
+    @property
+    def index_only(self) -> list[Remark]:
+        return self.cap_state.index_only if self.cap_state is not None else []
+
+    def is_known(self, remark: Remark, key: RemarkKey, all_remarks: dict[RemarkKey, Remark]) -> bool:
+        return key in all_remarks or key in self.omitted.get(remark.Name, ())
+
+    def add(self, remark: Remark, key: RemarkKey, cap: int) -> bool:
+        """Add a new remark; return whether it belongs in the index"""
+        state = self.cap_state
+        if state is None:
+            # No Name can have reached the cap while the line holds fewer remarks
+            if not cap or len(self) < cap:
+                self.append(remark)
+                return True
+            state = self.cap_state = _CapState(self)
+        location = (remark.Column, remark.pass_with_diff_prefix)
+        count = state.counts.get(remark.Name, 0)
+        if count < cap:
+            self.append(remark)
+            state.counts[remark.Name] = count + 1
+            state.locations.add(location)
+            return True
+        state.omitted.setdefault(remark.Name, set()).add(key)
+        if location not in state.locations:
+            state.locations.add(location)
+            state.index_only.append(remark)
+            return True
+        return False
+
+    def omit(self, name: str, keys: Iterable[RemarkKey]):
+        """Record remarks of `name` that another LineRemarks omitted"""
+        if self.cap_state is None:
+            self.cap_state = _CapState(self)
+        self.cap_state.omitted.setdefault(name, set()).update(keys)
+
+
+DictLine2Remarks = dict[int, LineRemarks]
 DictFile2Remarks = dict[str, DictLine2Remarks]
 
 
+def new_file_remarks() -> DictFile2Remarks:
+    return defaultdict(functools.partial(defaultdict, LineRemarks))
+
+
+def num_unique_remarks(file_remarks: DictFile2Remarks) -> int:
+    """Unique remarks in `file_remarks` - displayed, or omitted by the per-line cap"""
+    return sum(len(line_remarks) + sum(len(keys) for keys in line_remarks.omitted.values())
+               for d in file_remarks.values() for line_remarks in d.values())
+
+
+def merge_file_remarks(file_remarks_job: DictFile2Remarks,
+                       all_remarks: dict[RemarkKey, Remark],
+                       merged: DictFile2Remarks,
+                       max_hotness: int,
+                       max_remarks_per_line: int):
+    """Merge the remarks of one job into `merged`, capping them the same way"""
+    for filename, d in file_remarks_job.items():
+        for line, line_remarks in d.items():
+            merged_line = merged[filename][line]
+            for remark in itertools.chain(line_remarks, line_remarks.index_only):
+                # Bring max_hotness into the remarks so that
+                # RelativeHotness does not depend on an external global.
+                remark.max_hotness = max_hotness
+                key = remark.key
+                if not merged_line.is_known(remark, key, all_remarks):
+                    if merged_line.add(remark, key, max_remarks_per_line):
+                        all_remarks[key] = remark
+            if line_remarks.omitted:
+                displayed = {remark.key for remark in merged_line}
+                for name, keys in line_remarks.omitted.items():
+                    merged_line.omit(name, (key for key in keys if key not in displayed))
+
+
 class Analysis(Remark):
     yaml_tag = '!Analysis'
 
@@ -302,102 +479,712 @@ class Failure(Missed):
     yaml_tag = '!Failure'
 
 
+def split_alternatives(pattern: str) -> list[str]:
+    """Split a regex into its top-level alternatives: 'a|(b|c)' -> ['a', '(b|c)']"""
+    alternatives = []
+    depth = 0
+    in_class = False
+    start = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+            # A ']' right after '[' or '[^' is a literal
+            if pattern[i + 1:i + 2] == '^':
+                i += 1
+            if pattern[i + 1:i + 2] == ']':
+                i += 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            alternatives.append(pattern[start:i])
+            start = i + 1
+        i += 1
+    alternatives.append(pattern[start:])
+    return alternatives
+
+
+class RemarkFilter:
+    """
+    Decides which remarks get_remarks drops, cheapest checks first.
+
+    Verdicts of the regex filters are cached per unique Name and per unique
+    (interned) Args tuple, so every distinct name/message is matched once per
+    process. exclude_text is matched against the plain argument text -
+    demangled, or raw (mangled) when `demangle_text` is False, which avoids
+    the demangler altogether. excluded_by() returns a label naming the filter
+    that dropped the remark - for regexes, the matching top-level alternative -
+    so callers can count hits per filter.
+    """
+
+    def __init__(self,
+                 exclude_names: str | None = None,
+                 exclude_text: str | None = None,
+                 collect_opt_success: bool = False,
+                 annotate_external: bool = False,
+                 demangle_text: bool = True):
+        self.collect_opt_success = collect_opt_success
+        self.annotate_external = annotate_external
+        self.demangle_text = demangle_text
+        self.exclude_names_re = self._compile(exclude_names)
+        self.exclude_text_re = self._compile(exclude_text)
+        self.name_verdicts: dict[str, str | None] = {}
+        self.text_verdicts: dict[tuple[tuple[str, ...]], str | None] = {}
+
+    @staticmethod
+    def _compile(pattern: str | None) -> tuple[re.Pattern, list[re.Pattern]] | None:
+        if not pattern:
+            return None
+        return re.compile(pattern), [re.compile(alt) for alt in split_alternatives(pattern)]
+
+    @staticmethod
+    def _match(regexes: tuple[re.Pattern, list[re.Pattern]], label: str, text: str) -> str | None:
+        combined, alternatives = regexes
+        if not combined.search(text):
+            return None
+        for alt in alternatives:
+            if alt.search(text):
+                return f"{label}: {alt.pattern}"
+        return f"{label}: {combined.pattern}"
+
+    def excluded_by(self, remark: Remark) -> str | None:
+        if not self.collect_opt_success and not isinstance(remark, Missed):
+            return 'collect_opt_success'
+
+        if not self.annotate_external and os.path.isabs(remark.File):
+            return 'annotate_external'
+
+        if self.exclude_names_re:
+            try:
+                verdict = self.name_verdicts[remark.Name]
+            except KeyError:
+                verdict = self._match(self.exclude_names_re, 'exclude_names', remark.Name)
+                bounded_put(self.name_verdicts, remark.Name, verdict)
+            if verdict:
+                return verdict
+
+        if self.exclude_text_re:
+            try:
+                verdict = self.text_verdicts[remark.Args]
+            except (KeyError, TypeError):
+                verdict = self._match(self.exclude_text_re, 'exclude_text', remark.text(self.demangle_text))
+                if type(remark.Args) is tuple:
+                    bounded_put(self.text_verdicts, remark.Args, verdict)
+            if verdict:
+                return verdict
+
+        return None
+
+
+# Keep one filter (and its verdict caches) per worker process, across files
+@functools.lru_cache(maxsize=None)
+def get_remark_filter(*args) -> RemarkFilter:
+    return RemarkFilter(*args)
+
+
+# Hotness from a sample profile, for builds without PGO. Samples are indexed
+# by (file name, line) and by function name, so that assigning hotness to a
+# remark is a couple of dict lookups.
+
+def _strip_params(name: str) -> str:
+    """'ns::f(int, char*) const' -> 'ns::f' - the form the default demangler (c++filt -p) produces"""
+    end = name.rfind(')')
+    if end < 0 or not re.fullmatch(r'(\s*(const|volatile|noexcept|&&|&))*\s*', name[end + 1:]):
+        return name
+    depth = 0
+    for i in range(end, -1, -1):
+        if name[i] == ')':
+            depth += 1
+        elif name[i] == '(':
+            depth -= 1
+            if depth == 0:
+                return name[:i] if i else name
+    return name
+
+
+def _path_tail(path: str) -> str:
+    # Remark paths are often relative to the build directory ('../src/a.cc')
+    parts = [part for part in re.split(r'[\\/]+', path) if part not in ('', '.', '..')]
+    return '/'.join(parts)
+
+
+class SampleProfile:
+    """
+    CPU samples per source line and per function, read from `perf script`
+    output (optionally with `-F +srcline`), from folded stacks
+    (`stackcollapse-perf.pl` output: 'outer;...;leaf count') or from per
+    line counts ('path/to/file.cc:123 count'). Only the leaf frame of each
+    sample - the code actually running - is counted.
+    """
+
+    def __init__(self):
+        # (file name, line) -> [(path tail, samples)], to resolve differently rooted paths
+        self.line_samples: dict[tuple[str, int], list[tuple[str, int]]] = {}
+        self.function_samples: Counter[str] = Counter()
+
+    def add_line(self, path: str, line: int, samples: int):
+        tail = _path_tail(path)
+        entries = self.line_samples.setdefault((tail.rsplit('/', 1)[-1], line), [])
+        for i, (entry_tail, entry_samples) in enumerate(entries):
+            if entry_tail == tail:
+                entries[i] = (tail, entry_samples + samples)
+                return
+        entries.append((tail, samples))
+
+    def add_function(self, name: str, samples: int):
+        # Annotations added by stackcollapse-perf.pl --all: _[k]ernel, _[j]it, _[i]nlined, ...
+        name = re.sub(r'_\[\w\]$', '', name)
+        if name and name != '[unknown]':
+            self.function_samples[_strip_params(name)] += samples
+
+    def line_hotness(self, file: str, line: int) -> int:
+        entries = self.line_samples.get((os.path.basename(file), line))
+        if not entries:
+            return 0
+        tail = _path_tail(file)
+        return sum(samples for entry_tail, samples in entries
+                   if entry_tail == tail or entry_tail.endswith('/' + tail) or tail.endswith('/' + entry_tail))
+
+    def function_hotness(self, function: str) -> int:
+        samples = self.function_samples.get(function)
+        if samples is None and function.startswith('_Z'):
+            # Profilers usually report demangled names
+            samples = self.function_samples.get(_strip_params(Remark.demangle(function)))
+        return samples or 0
+
+    def hotness_of(self, remark: Remark) -> int:
+        """The samples on the remark's line if the profile has line information, else those of its function"""
+        if self.line_samples:
+            return self.line_hotness(remark.File, remark.Line)
+        return self.function_hotness(remark.Function)
+
+    def _read_perf_script(self, lines: Iterable[str]):
+        frame_re = re.compile(r'\s+[0-9a-fA-F]+\s+(.*?)(?:\+0x[0-9a-fA-F]+)?\s+\(.*\)')
+        srcline_re = re.compile(r'\s+(\S.*):(\d+)')
+        state = 'done'
+        for line in lines:
+            if not line[:1].isspace():
+                state = 'leaf'  # A sample header - its first frame is the leaf
+                continue
+            if state == 'leaf':
+                match = frame_re.fullmatch(line)
+                if match:
+                    self.add_function(match.group(1), 1)
+                    state = 'srcline'
+            elif state == 'srcline':
+                match = srcline_re.fullmatch(line)
+                if match:
+                    self.add_line(match.group(1), int(match.group(2)), 1)
+                state = 'done'
+
+    def _read_counts(self, lines: Iterable[str]):
+        for line in lines:
+            stack, _, samples = line.rpartition(' ')
+            try:
+                count = int(samples)
+            except ValueError:
+                logging.warning(f"Unrecognized sample profile line: {line}")
+                continue
+            match = re.fullmatch(r'(.+):(\d+)', stack) if ';' not in stack else None
+            if match:
+                self.add_line(match.group(1), int(match.group(2)), count)
+            else:
+                self.add_function(stack.rsplit(';', 1)[-1], count)
+
+    @classmethod
+    def read(cls, profile_file: str) -> SampleProfile:
+        profile = cls()
+        with io.open(profile_file, encoding='utf-8', errors='replace') as f:
+            lines = (line.rstrip() for line in f if line.strip() and not line.startswith('#'))
+            head = list(itertools.islice(lines, 2))
+            # In perf script output, every sample header is followed by indented frames
+            if len(head) == 2 and head[1][:1].isspace():
+                profile._read_perf_script(itertools.chain(head, lines))
+            else:
+                profile._read_counts(itertools.chain(head, lines))
+        logging.info(f"Read samples for {len(profile.line_samples)} lines and "
+                     f"{len(profile.function_samples)} functions from {profile_file}")
+        return profile
+
+
+_sample_profile: SampleProfile | None = None
+
+
+def set_sample_profile(profile: SampleProfile | None):
+    # Pool initializer: the profile is shipped to each worker once
+    global _sample_profile
+    _sample_profile = profile
+
+
 def get_remarks(input_file: str,
                 exclude_names: str | None = None,
                 exclude_text: str | None = None,
                 collect_opt_success: bool = False,
-                annotate_external: bool = False) -> \
-        tuple[int, dict[RemarkKey, Remark], DictFile2Remarks]:
+                annotate_external: bool = False,
+                demangle_text: bool = True,
+                max_remarks_per_line: int = 5) -> \
+        tuple[int, dict[RemarkKey, Remark], DictFile2Remarks, Counter[str], dict[str, tuple]]:
     max_hotness = 0
     all_remarks: dict[RemarkKey, Remark] = dict()
-    file_remarks: DictFile2Remarks = defaultdict(functools.partial(defaultdict, list))
+    file_remarks = new_file_remarks()
+    filter_hits: Counter[str] = Counter()
+    # Where functions are defined, for the inline context links. Collected
+    # from all remarks - including dropped ones, which are most of them.
+    function_locs: dict[str, tuple] = dict()
+    remark_filter = get_remark_filter(exclude_names, exclude_text, collect_opt_success,
+                                      annotate_external, demangle_text)
+    # Args shared by the kept remarks of this file - dropped ones are not pinned
+    interned_args: dict[tuple[tuple[str, ...]], tuple[tuple[str, ...]]] = dict()
 
     # TODO: filter unique name+file+line loc *here*
     with io.open(input_file, encoding='utf-8') as f:
         docs: Iterator[Remark] = yaml.load_all(f, Loader=Loader)
 
-        exclude_text_re = re.compile(exclude_text) if exclude_text else None
-        exclude_names_re = re.compile(exclude_names) if exclude_names else None
-
         for remark in docs:
             remark.canonicalize()
-            # Avoid remarks withoug debug location or if they are duplicated
-            if not hasattr(remark, 'DebugLoc') or remark.key in all_remarks:
+            remark.collect_function_locs(function_locs)
+
+            # Avoid remarks withoug debug location
+            if not hasattr(remark, 'DebugLoc'):
                 continue
 
-            if not collect_opt_success and \
-                    not (isinstance(remark, Missed) | isinstance(remark, Failure)):
+            excluded_by = remark_filter.excluded_by(remark)
+            if excluded_by:
+                filter_hits[excluded_by] += 1
                 continue
 
-            if not annotate_external:
-                if os.path.isabs(remark.File):
-                    continue
+            # A sample profile replaces the PGO hotness, if any - the two don't mix
+            if _sample_profile is not None:
+                remark.Hotness = _sample_profile.hotness_of(remark)
 
-            if exclude_names_re and exclude_names_re.search(remark.Name):
-                continue
+            remark.intern_args(interned_args)
 
-            if exclude_text_re and exclude_text_re.search(remark.message):
+            # Avoid duplicated remarks
+            key = remark.key
+            line_remarks = file_remarks[remark.File][remark.Line]
+            if line_remarks.is_known(remark, key, all_remarks):
                 continue
 
-            all_remarks[remark.key] = remark
-
-            file_remarks[remark.File][remark.Line].append(remark)
+            # Only the remarks displayed (or needed by the index) are kept
+            if line_remarks.add(remark, key, max_remarks_per_line):
+                all_remarks[key] = remark
 
             # If we're reading a back a diff yaml file, max_hotness is already
             # captured which may actually be less than the max hotness found
-            # in the file.
-            if hasattr(remark, 'max_hotness'):
+            # in the file. (Only check the instance - the class always has a
+            # max_hotness default.)
+            if 'max_hotness' in vars(remark):
                 max_hotness = remark.max_hotness
             max_hotness = max(max_hotness, remark.Hotness)
 
-    return max_hotness, all_remarks, file_remarks
+    return max_hotness, all_remarks, file_remarks, filter_hits, function_locs
 
 
-def gather_results(filenames: list[str],
+def gather_results(filenames: Iterable[str],
                    num_jobs: int,
                    annotate_external: bool = False,
                    exclude_names: str | None = None,
                    exclude_text: str | None = None,
-                   collect_opt_success: bool = False):
+                   collect_opt_success: bool = False,
+                   demangle_text: bool = True,
+                   max_remarks_per_line: int = 5,
+                   sample_profile: SampleProfile | None = None):
     logging.info('Reading YAML files...')
 
+    input_files: list[str] = []
     remarks = optpmap.parallel_map(
-        get_remarks, filenames, num_jobs, exclude_names, exclude_text, collect_opt_success, annotate_external)
-
-    max_hotness = max(entry[0] for entry in remarks)
-
-    def merge_file_remarks(file_remarks_job: DictFile2Remarks,
-                           all_remarks: dict[RemarkKey, Remark],
-                           merged: DictFile2Remarks):
-        for filename, d in file_remarks_job.items():
-            for line, remarks in d.items():
-                for remark in remarks:
-                    # Bring max_hotness into the remarks so that
-                    # RelativeHotness does not depend on an external global.
-                    remark.max_hotness = max_hotness
-                    if remark.key not in all_remarks:
-                        merged[filename][line].append(remark)
+        get_remarks, _recorded(filenames, input_files), num_jobs, exclude_names, exclude_text,
+        collect_opt_success, annotate_external, demangle_text, max_remarks_per_line,
+        initializer=set_sample_profile, initargs=(sample_profile,))
+    # Merge in a fixed order - discovery order is not deterministic
+    remarks = [entry for _, entry in sorted(zip(input_files, remarks), key=lambda x: x[0])]
+
+    max_hotness = max((entry[0] for entry in remarks), default=0)
 
     all_remarks: dict[RemarkKey, Remark] = dict()
-    file_remarks: DictFile2Remarks = defaultdict(functools.partial(defaultdict, list))
-    for _, all_remarks_job, file_remarks_job in remarks:
-        merge_file_remarks(file_remarks_job, all_remarks, file_remarks)
-        all_remarks.update(all_remarks_job)
+    file_remarks = new_file_remarks()
+    filter_hits: Counter[str] = Counter()
+    function_locs: dict[str, tuple] = dict()
+    for _, _, file_remarks_job, filter_hits_job, function_locs_job in remarks:
+        merge_file_remarks(file_remarks_job, all_remarks, file_remarks, max_hotness, max_remarks_per_line)
+        filter_hits.update(filter_hits_job)
+        function_locs.update(function_locs_job)
 
-    return all_remarks, file_remarks, max_hotness != 0
+    log_filter_hits(filter_hits)
 
+    return all_remarks, file_remarks, max_hotness != 0, function_locs
 
-def find_opt_files(*dirs_or_files: str) -> list[str]:
-    all = []
+
+class LocationGroup:
+    """
+    All the remarks at one (File, Line, Column, pass) location - a single row
+    of the index - summarized by a representative remark.
+    """
+    __slots__ = ('remark', 'count', 'functions', 'hotness')
+
+    def __init__(self, remark: Remark):
+        self.remark = remark
+        self.count = 0
+        self.functions: set[str] = set()
+        self.hotness = 0
+
+    @property
+    def RelativeHotness(self) -> str:
+        if self.remark.max_hotness:
+            return "{0:.2f}%".format(self.hotness * 100. / self.remark.max_hotness)
+        else:
+            return ''
+
+
+def group_locations(all_remarks: dict[RemarkKey, Remark], file_remarks: DictFile2Remarks) -> list[LocationGroup]:
+    """Group remarks by location in a single pass; the first remark seen at a location represents it"""
+    groups: dict[tuple[str, int, int, str], LocationGroup] = dict()
+    for remark in all_remarks.values():
+        location = (remark.File, remark.Line, remark.Column, remark.pass_with_diff_prefix)
+        group = groups.get(location)
+        if group is None:
+            group = groups[location] = LocationGroup(remark)
+        group.count += 1
+        group.functions.add(remark.Function)
+        if remark.Hotness > group.hotness:
+            group.hotness = remark.Hotness
+
+    # Remarks omitted by the per-line cap only left their keys behind - enough to count them
+    for d in file_remarks.values():
+        for line_remarks in d.values():
+            for keys in line_remarks.omitted.values():
+                for key in keys:
+                    if key in all_remarks:
+                        continue
+                    _, pass_with_diff_prefix, _, file, line, column, function, _ = key
+                    group = groups.get((file, line, column, pass_with_diff_prefix))
+                    if group is not None:
+                        group.count += 1
+                        group.functions.add(function)
+
+    return list(groups.values())
+
+
+def _recorded(items: Iterable[str], record: list[str]) -> Iterator[str]:
+    for item in items:
+        record.append(item)
+        yield item
+
+
+def log_filter_hits(filter_hits: Counter[str]):
+    if filter_hits:
+        logging.info('Remarks dropped by filters:')
+        for label, hits in filter_hits.most_common():
+            logging.info(f"  {hits:d}\t{label}")
+
+
+# Library API: stream remarks as plain records, without building the
+# per-file structures the report needs.
+
+class RemarkRecord(NamedTuple):
+    """A canonicalized remark, detached from the YAML loader - cheap to pickle and to keep"""
+    Kind: str  # Remark subclass name - 'Missed', 'Passed', 'Analysis', ...
+    Pass: str
+    Name: str
+    File: str
+    Line: int
+    Column: int
+    Function: str
+    Hotness: int
+    Args: tuple[tuple[str, ...]]
+
+    def text(self, demangle: bool = True) -> str:
+        return "".join([Remark.getArgText(mapping, demangle) for mapping in self.Args])
+
+
+_record_filter: RemarkFilter | None = None
+
+
+def _set_record_filter(remark_filter: RemarkFilter | None):
+    global _record_filter
+    _record_filter = remark_filter
+
+
+def get_records(input_file: str) -> list[RemarkRecord]:
+    """The remarks of one file that pass the current filter, deduplicated within the file"""
+    records: dict[RemarkRecord, None] = dict()
+    with io.open(input_file, encoding='utf-8') as f:
+        docs: Iterator[Remark] = yaml.load_all(f, Loader=Loader)
+        for remark in docs:
+            if not hasattr(remark, 'DebugLoc'):
+                continue
+            remark.canonicalize()
+            if _record_filter is not None and _record_filter.excluded_by(remark):
+                continue
+            record = RemarkRecord(remark.__class__.__name__, remark.Pass, remark.Name, remark.File,
+                                  remark.Line, remark.Column, remark.Function, remark.Hotness, remark.Args)
+            records[record] = None
+    return list(records)
+
+
+def iter_remarks(paths: Iterable[str], filters: RemarkFilter | None = None,
+                 jobs: int | None = 1) -> Iterator[RemarkRecord]:
+    """
+    Yield the remarks of the optimization record files under `paths` (files
+    or directories), as the workers parse them - `jobs` processes, all CPUs
+    if None.
+
+    Only remarks with a debug location are yielded; `filters` (see
+    RemarkFilter) is applied in the workers, so excluded remarks are never
+    sent back. Remarks are deduplicated within each record file, but not
+    across files - that would take memory proportional to the output.
+    Files are yielded in the order they are parsed, and at most two parsed
+    files per worker are held in memory at a time.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    for records in optpmap.parallel_imap_unordered(get_records, iter_opt_files(*paths), jobs,
+                                                   initializer=_set_record_filter, initargs=(filters,)):
+        yield from records
+
+
+K = TypeVar('K')
+
+
+class RecordGroup(Generic[K]):
+    """Running totals of the records sharing a group_by key, represented by the first of them"""
+    __slots__ = ('key', 'first', 'count', 'hotness')
+
+    def __init__(self, key: K, first: RemarkRecord):
+        self.key = key
+        self.first = first
+        self.count = 0
+        self.hotness = 0
+
+    def __repr__(self) -> str:
+        return f"RecordGroup({self.key!r}, count={self.count}, hotness={self.hotness})"
+
+
+def group_by(records: Iterable[RemarkRecord], key: Callable[[RemarkRecord], K]) -> dict[K, RecordGroup[K]]:
+    """
+    Count `records` per `key(record)`, also keeping the maximal hotness.
+    Memory grows with the number of distinct keys, not of records, so it
+    can consume iter_remarks() over any number of remarks. E.g.:
+
+        group_by(iter_remarks(['build']), lambda r: (r.File, r.Name))
+    """
+    groups: dict[K, RecordGroup[K]] = dict()
+    for record in records:
+        k = key(record)
+        group = groups.get(k)
+        if group is None:
+            group = groups[k] = RecordGroup(k, record)
+        group.count += 1
+        if record.Hotness > group.hotness:
+            group.hotness = record.Hotness
+    return groups
+
+
+# Out-of-core processing: instead of gathering all remarks in memory, parse
+# workers spill them to on-disk partitions (one directory per partition,
+# one file per worker process), keyed by source file. A partition can then be
+# loaded, deduplicated and rendered on its own - every remark for a given
+# source file lives in the same partition.
+
+def partition_of(file: str, num_partitions: int) -> int:
+    # crc32 rather than hash(), which is salted differently in each process
+    return zlib.crc32(file.encode('utf-8')) % num_partitions
+
+
+def partition_dirs(spill_dir: str, num_partitions: int) -> list[str]:
+    return [os.path.join(spill_dir, f"{partition:04d}") for partition in range(num_partitions)]
+
+
+def spill_remarks(input_file: str,
+                  spill_dir: str,
+                  num_partitions: int,
+                  exclude_names: str | None = None,
+                  exclude_text: str | None = None,
+                  collect_opt_success: bool = False,
+                  annotate_external: bool = False,
+                  demangle_text: bool = True,
+                  max_remarks_per_line: int = 5) -> \
+        tuple[int, dict[str, tuple], Counter[str]]:
+    max_hotness, _, file_remarks, filter_hits, function_locs = get_remarks(
+        input_file, exclude_names, exclude_text, collect_opt_success, annotate_external, demangle_text,
+        max_remarks_per_line)
+
+    partitions: dict[int, DictFile2Remarks] = defaultdict(dict)
+    for filename, line_remarks in file_remarks.items():
+        partitions[partition_of(filename, num_partitions)][filename] = line_remarks
+
+    dirs = partition_dirs(spill_dir, num_partitions)
+    for partition, partition_remarks in partitions.items():
+        # Only this process appends to this file, so no locking is needed
+        with open(os.path.join(dirs[partition], f"{os.getpid()}.pickle"), 'ab') as f:
+            pickle.dump((input_file, partition_remarks), f, pickle.HIGHEST_PROTOCOL)
+
+    return max_hotness, function_locs, filter_hits
+
+
+def spill_results(filenames: Iterable[str],
+                  spill_dir: str,
+                  num_partitions: int,
+                  num_jobs: int,
+                  annotate_external: bool = False,
+                  exclude_names: str | None = None,
+                  exclude_text: str | None = None,
+                  collect_opt_success: bool = False,
+                  demangle_text: bool = True,
+                  max_remarks_per_line: int = 5,
+                  sample_profile: SampleProfile | None = None) -> tuple[int, dict[str, tuple]]:
+    """
+    Out-of-core counterpart of gather_results: spill the remarks to
+    `num_partitions` partitions under `spill_dir`, keeping in memory only
+    the global state - max hotness and the function location map.
+    """
+    logging.info(f'Reading YAML files into {num_partitions} partitions...')
+    for dir in partition_dirs(spill_dir, num_partitions):
+        os.makedirs(dir, exist_ok=True)
+
+    input_files: list[str] = []
+    results = optpmap.parallel_map(
+        spill_remarks, _recorded(filenames, input_files), num_jobs, spill_dir, num_partitions, exclude_names,
+        exclude_text, collect_opt_success, annotate_external, demangle_text, max_remarks_per_line,
+        initializer=set_sample_profile, initargs=(sample_profile,))
+    results = [entry for _, entry in sorted(zip(input_files, results), key=lambda x: x[0])]
+
+    max_hotness = 0
+    function_locs: dict[str, tuple] = dict()
+    filter_hits: Counter[str] = Counter()
+    for max_hotness_job, function_locs_job, filter_hits_job in results:
+        max_hotness = max(max_hotness, max_hotness_job)
+        function_locs.update(function_locs_job)
+        filter_hits.update(filter_hits_job)
+
+    log_filter_hits(filter_hits)
+
+    return max_hotness, function_locs
+
+
+def load_partition(partition_dir: str, max_hotness: int,
+                   max_remarks_per_line: int = 5) -> tuple[dict[RemarkKey, Remark], DictFile2Remarks]:
+    chunks: list[tuple[str, DictFile2Remarks]] = []
+    for spill_file in os.listdir(partition_dir):
+        with open(os.path.join(partition_dir, spill_file), 'rb') as f:
+            while True:
+                try:
+                    chunks.append(pickle.load(f))
+                except EOFError:
+                    break
+    # Merge in input file order, like gather_results - which worker spilled
+    # what is not deterministic
+    chunks.sort(key=lambda chunk: chunk[0])
+
+    all_remarks: dict[RemarkKey, Remark] = dict()
+    file_remarks = new_file_remarks()
+    for _, file_remarks_job in chunks:
+        merge_file_remarks(file_remarks_job, all_remarks, file_remarks, max_hotness, max_remarks_per_line)
+    return all_remarks, file_remarks
+
+
+def _scan_dir(dir: str, dev: int) -> tuple[list[str], list[str], int]:
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Exclude mounted directories and symlinks (like os.walk default).
+                    # scandir doesn't fill st_dev on Windows, hence ismount there.
+                    if os.name == 'nt':
+                        if not os.path.ismount(entry.path):
+                            subdirs.append(entry.path)
+                    elif entry.stat(follow_symlinks=False).st_dev == dev:
+                        subdirs.append(entry.path)
+                elif '.opt.yaml' in entry.name:  # i.e. fnmatch "*.opt.yaml*"
+                    files.append(entry.path)
+    except OSError:
+        pass  # Unreadable directories are skipped, like os.walk does
+    return files, subdirs, dev
+
+
+def iter_opt_files(*dirs_or_files: str, num_threads: int | None = None) -> Iterator[str]:
+    """
+    Lazily yield the optimization record files under `dirs_or_files`.
+
+    Directories are scanned in parallel by a thread pool, and files are
+    yielded as soon as their directory has been listed, so parsing can start
+    before the walk completes. The order of the results is not deterministic.
+    """
+    roots = []
     for dir_or_file in dirs_or_files:
         if os.path.isfile(dir_or_file):
-            all.append(dir_or_file)
+            yield dir_or_file
+        elif os.path.isdir(dir_or_file):
+            roots.append(dir_or_file)
+    if not roots:
+        return
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = {executor.submit(_scan_dir, root, os.stat(root).st_dev) for root in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs, dev = future.result()
+                pending.update(executor.submit(_scan_dir, subdir, dev) for subdir in subdirs)
+                yield from files
+
+
+def find_opt_files(*dirs_or_files: str) -> list[str]:
+    return sorted(iter_opt_files(*dirs_or_files))
+
+
+def _opt_file_of_command(command: dict) -> str | None:
+    # Where clang writes the record for a compile_commands.json entry: the
+    # explicit -foptimization-record-file, else the object file with its
+    # extension replaced by .opt.yaml
+    if 'arguments' in command:
+        arguments = command['arguments']
+    else:
+        arguments = shlex.split(command.get('command', ''))
+    output = command.get('output')
+    for i, arg in enumerate(arguments):
+        if arg.startswith('-foptimization-record-file='):
+            output = arg.split('=', 1)[1]
+            break
+        if arg == '-o' and i + 1 < len(arguments):
+            output = os.path.splitext(arguments[i + 1])[0] + '.opt.yaml'
+        elif arg.startswith('-o') and len(arg) > 2 and not arg.startswith('-obj'):
+            output = os.path.splitext(arg[2:])[0] + '.opt.yaml'
+    else:
+        if output is None:
+            if 'file' not in command:
+                return None
+            output = os.path.basename(command['file'])
+        if not output.endswith('.opt.yaml'):
+            output = os.path.splitext(output)[0] + '.opt.yaml'
+    return os.path.join(command.get('directory', ''), output)
+
+
+def read_manifest(manifest: str) -> Iterator[str]:
+    """
+    Yield the optimization record files listed in `manifest`, without walking
+    any directory. The manifest is either a compile_commands.json - records
+    are expected next to the object files, and missing ones are skipped - or a
+    text file with one path per line ('#' starts a comment line).
+    """
+    with open(manifest, encoding='utf-8') as f:
+        if manifest.endswith('.json'):
+            for command in json.load(f):
+                opt_file = _opt_file_of_command(command)
+                if opt_file and os.path.isfile(opt_file):
+                    yield opt_file
         else:
-            for dir, subdirs, files in os.walk(dir_or_file):
-                # Exclude mounted directories and symlinks (os.walk default).
-                subdirs[:] = [d for d in subdirs
-                              if not os.path.ismount(os.path.join(dir, d))]
-                for file in files:
-                    if fnmatch.fnmatch(file, "*.opt.yaml*"):
-                        all.append(os.path.join(dir, file))
-    return all
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
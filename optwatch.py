@@ -0,0 +1,114 @@
+from __future__ import annotations
+import os
+import sys
+import time
+import logging
+from typing import TYPE_CHECKING
+from optrecord import iter_opt_files
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+try:
+    # Use inotify where available, to pick up files as soon as they are written
+    import inotify_simple  # type: ignore
+except ImportError:
+    inotify_simple = None
+
+
+def watch_opt_files(dirs: list[str], interval: float = 1.0, idle_timeout: float = 0,
+                    idle_batches: bool = False) -> Iterator[list[str]]:
+    """
+    Yield batches of optimization record files under `dirs` that are new or
+    modified, starting with the ones already there. With `idle_batches`, an
+    empty batch is yielded whenever `interval` seconds passed without a
+    change, so the caller can catch up on work it deferred.
+
+    Uses inotify (through the optional inotify_simple package) on Linux, and
+    polls every `interval` seconds otherwise. Stops once no file has changed
+    for `idle_timeout` seconds; with the default of 0, watches until
+    interrupted.
+    """
+    if inotify_simple is not None and sys.platform.startswith('linux'):
+        yield from _watch_inotify(dirs, interval, idle_timeout, idle_batches)
+    else:
+        logging.info("inotify_simple is not available - polling for changes")
+        yield from _watch_polling(dirs, interval, idle_timeout, idle_batches)
+
+
+def _watch_polling(dirs: list[str], interval: float, idle_timeout: float, idle_batches: bool) -> Iterator[list[str]]:
+    seen: dict[str, tuple[int, int]] = {}
+    changed: dict[str, tuple[int, int]] = {}
+    idle_since = time.monotonic()
+    while True:
+        current: dict[str, tuple[int, int]] = {}
+        for file in iter_opt_files(*dirs):
+            try:
+                st = os.stat(file)
+            except OSError:
+                continue
+            current[file] = (st.st_size, st.st_mtime_ns)
+
+        # A file may still be being written - pick it up only once it stayed
+        # unchanged between two polls.
+        batch = [file for file, sig in current.items() if seen.get(file) != sig and changed.get(file) == sig]
+        changed = {file: sig for file, sig in current.items() if seen.get(file) != sig}
+        for file in batch:
+            seen[file] = current[file]
+
+        if batch:
+            yield sorted(batch)
+            idle_since = time.monotonic()
+        elif changed:
+            idle_since = time.monotonic()
+        elif idle_timeout and time.monotonic() - idle_since > idle_timeout:
+            return
+        elif idle_batches:
+            yield []
+        time.sleep(interval)
+
+
+def _watch_inotify(dirs: list[str], interval: float, idle_timeout: float, idle_batches: bool) -> Iterator[list[str]]:
+    flags = inotify_simple.flags
+    inotify = inotify_simple.INotify()
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+    watched: dict[int, str] = {}
+
+    def watch_tree(root: str):
+        for dir, _, _ in os.walk(root):
+            try:
+                watched[inotify.add_watch(dir, mask)] = dir
+            except OSError:
+                pass
+
+    # Watch first, then list what is already there, so nothing slips in between
+    for dir in dirs:
+        watch_tree(dir)
+    batch = set(iter_opt_files(*dirs))
+    idle_since = time.monotonic()
+    try:
+        while True:
+            if batch:
+                yield sorted(batch)
+                batch = set()
+                idle_since = time.monotonic()
+
+            # read_delay coalesces the bursts of events of a busy build
+            events = inotify.read(timeout=int(interval * 1000), read_delay=100)
+            for event in events:
+                if event.wd not in watched:
+                    continue
+                path = os.path.join(watched[event.wd], event.name)
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        watch_tree(path)
+                        batch.update(iter_opt_files(path))
+                elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO) and '.opt.yaml' in event.name:
+                    batch.add(path)
+
+            if not events:
+                if idle_timeout and time.monotonic() - idle_since > idle_timeout:
+                    return
+                if idle_batches:
+                    yield []
+    finally:
+        inotify.close()
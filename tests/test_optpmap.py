@@ -0,0 +1,38 @@
+"""
+Work distribution of the process pool. Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import optpmap  # noqa: E402
+
+
+def _pid_of_slow_task(_):
+    time.sleep(0.05)
+    return os.getpid()
+
+
+class ParallelMapTest(unittest.TestCase):
+    def test_small_lazy_input_uses_all_workers(self):
+        # Fewer items than LAZY_CHUNKSIZE: a lazily discovered build with a
+        # few dozen record files must not end up on a single worker
+        processes = 4
+        items = (i for i in range(4 * processes))
+        start = time.perf_counter()
+        pids = optpmap.parallel_map(_pid_of_slow_task, items, processes)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(pids), 4 * processes)
+        self.assertGreaterEqual(len(set(pids)), processes)
+        # Serially this takes 0.8s
+        self.assertLess(elapsed, 0.6)
+
+    def test_lazy_input_keeps_order(self):
+        items = (i for i in range(500))
+        self.assertEqual(optpmap.parallel_map(abs, items, 4), list(range(500)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Startup cost: opt-viewer is run for many small incremental and CI
+invocations, so the modes that render nothing must not pay for the
+rendering and serving imports. Run with: python -m unittest discover tests
+"""
+from __future__ import annotations
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+OPT_VIEWER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'opt-viewer.py')
+
+REMARK = '''--- !Missed
+Pass:            inline
+Name:            NoDefinition
+DebugLoc:        { File: main.cc, Line: 10, Column: 5 }
+Function:        _Z3fooi
+Args:
+  - Callee:          _Z3barv
+  - String:          ' will not be inlined into '
+  - Caller:          _Z3fooi
+...
+'''
+
+
+# Imported only to render or serve a report
+RENDERING_MODULES = ('pygments', 'http.server', 'optwatch')
+
+
+def run_opt_viewer(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, '-X', 'importtime', OPT_VIEWER, *args], capture_output=True, text=True)
+
+
+def imported_modules(importtime_output: str) -> set[str]:
+    # -X importtime lines: "import time: self [us] | cumulative | module"
+    return {line.rsplit('|', 1)[1].strip() for line in importtime_output.splitlines()
+            if line.startswith('import time:') and '|' in line}
+
+
+class StartupTest(unittest.TestCase):
+    def assertNoRenderingImports(self, result: subprocess.CompletedProcess):
+        modules = imported_modules(result.stderr)
+        self.assertIn('optrecord', modules)
+        for module in RENDERING_MODULES:
+            self.assertFalse(module in modules, f"{module} was imported")
+
+    def test_help_skips_rendering_imports(self):
+        result = run_opt_viewer('--help')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNoRenderingImports(result)
+
+    def test_check_skips_rendering_imports(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'main.opt.yaml'), 'w') as f:
+                f.write(REMARK)
+            budget = os.path.join(tmp, 'budget.json')
+            result = run_opt_viewer('-j1', '--check', budget, '--update-budget', tmp)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+            result = run_opt_viewer('-j1', '--check', budget, tmp)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertNoRenderingImports(result)
+
+
+if __name__ == '__main__':
+    unittest.main()